@@ -1,6 +1,7 @@
 import vapoursynth as vs
 import mvsfunc as mvf
 import math
+from fractions import Fraction
 
 """
 modified nnedi3_resample by xyx98
@@ -9,301 +10,511 @@ differences:
     use nnedi3cl instead of nnedi3
     add back fast mode,default is False
     add flat_kernel,flat_a1,flat_a2,flat_taps to control the algorithm in flat areas,default is nnedi3
+    add sample,vs.FLOAT runs the whole chain in 32-bit float with Expr transfer curves,default is vs.FLOAT for float input and 16-bit integer otherwise
+    add nnedi3_resample_plan,the decisions are cached per input format and geometry,ResamplePlan.explain() lists the stages
+    stages that would not change the clip are left out,with nothing to do the input is returned as is
 """
 
 def nnedi3_resample(input, target_width=None, target_height=None, src_left=None, src_top=None, src_width=None, src_height=None, csp=None, mats=None, matd=None, cplaces=None, cplaced=None, fulls=None, fulld=None, curves=None, curved=None, sigmoid=None, scale_thr=None,
                     nsize=None, nns=None, qual=None, etype=None, pscrn=None, device=None,list_device=False,
                     kernel=None, invks=False, taps=None, invkstaps=3, a1=None, a2=None, chromak_up=None, chromak_up_taps=None, chromak_up_a1=None, chromak_up_a2=None, chromak_down=None, chromak_down_invks=False, chromak_down_invkstaps=3, chromak_down_taps=None, chromak_down_a1=None, chromak_down_a2=None,
-                    fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None):
-    core = vs.get_core()
+                    fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None,stackuv=False,sample=None):
     funcName = 'nnedi3_resample'
     
     # Get property about input clip
     if not isinstance(input, vs.VideoNode):
         raise TypeError(funcName + ': This is not a clip!')
-
-    if list_device:
-        return core.nnedi3cl.NNEDI3CL(input,field=1,list_device=True)
-    
-    sFormat = input.format
-    
-    sColorFamily = sFormat.color_family
-    if sColorFamily == vs.COMPAT:
-        raise ValueError(funcName + ': Color family *COMPAT* of input clip is not supported!')
-    sIsGRAY = sColorFamily == vs.GRAY
-    sIsYUV = sColorFamily == vs.YUV or sColorFamily == vs.YCOCG
-    sIsRGB = sColorFamily == vs.RGB
-    
-    sbitPS = sFormat.bits_per_sample
-    
-    sHSubS = 1 << sFormat.subsampling_w
-    sVSubS = 1 << sFormat.subsampling_h
-    sIsSubS = sHSubS > 1 or sVSubS > 1
-    
-    sPlaneNum = sFormat.num_planes
     
-    # Get property about output clip
-    dFormat = sFormat if csp is None else core.get_format(csp)
-    
-    dColorFamily = dFormat.color_family
-    if dColorFamily == vs.COMPAT:
-        raise ValueError(funcName + ': Color family *COMPAT* of output clip is not supported!')
-    dIsGRAY = dColorFamily == vs.GRAY
-    dIsYUV = dColorFamily == vs.YUV or dColorFamily == vs.YCOCG
-    dIsRGB = dColorFamily == vs.RGB
-    
-    dbitPS = dFormat.bits_per_sample
-    
-    dHSubS = 1 << dFormat.subsampling_w
-    dVSubS = 1 << dFormat.subsampling_h
-    dIsSubS = dHSubS > 1 or dVSubS > 1
-    
-    dPlaneNum = dFormat.num_planes
-    
-    # Parameters of format
-    SD = input.width <= 1024 and input.height <= 576
-    HD = input.width <= 2048 and input.height <= 1536
+    if list_device:
+        return vs.get_core().nnedi3cl.NNEDI3CL(input,field=1,list_device=True)
     
-    if mats is None:
-        mats = "601" if SD else "709" if HD else "2020"
-    else:
-        mats = mats.lower()
-    if matd is None:
-        matd = mats
-    else:
-        matd = matd.lower()
-        # Matrix of output clip makes sense only if dst is not of RGB
-        if dIsRGB:
+    args = locals().copy()
+    del args['input'], args['funcName'], args['list_device']
+    return nnedi3_resample_plan(input.format.id, input.width, input.height, **args)(input)
+
+
+# Plans are cached per (input format, width, height, options), so building the same resize again only adds its filters
+_plan_cache = {}
+
+def nnedi3_resample_plan(format, width, height, target_width=None, target_height=None, src_left=None, src_top=None, src_width=None, src_height=None, csp=None, mats=None, matd=None, cplaces=None, cplaced=None, fulls=None, fulld=None, curves=None, curved=None, sigmoid=None, scale_thr=None,
+                         nsize=None, nns=None, qual=None, etype=None, pscrn=None, device=None,
+                         kernel=None, invks=False, taps=None, invkstaps=3, a1=None, a2=None, chromak_up=None, chromak_up_taps=None, chromak_up_a1=None, chromak_up_a2=None, chromak_down=None, chromak_down_invks=False, chromak_down_invkstaps=3, chromak_down_taps=None, chromak_down_a1=None, chromak_down_a2=None,
+                         fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None,stackuv=False,sample=None):
+    args = locals().copy()
+    args['format'] = getattr(format, 'id', format)
+    key = tuple(args.items())
+    plan = _plan_cache.get(key)
+    if plan is None:
+        plan = _plan_cache[key] = ResamplePlan(**args)
+    return plan
+
+
+# The decisions of nnedi3_resample for one input format and geometry, as a list of stages
+# Call the plan on a clip of that format and size to build the filters, explain() lists the stages with their cost
+class ResamplePlan:
+    def __init__(self, format, width, height, target_width=None, target_height=None, src_left=None, src_top=None, src_width=None, src_height=None, csp=None, mats=None, matd=None, cplaces=None, cplaced=None, fulls=None, fulld=None, curves=None, curved=None, sigmoid=None, scale_thr=None,
+                 nsize=None, nns=None, qual=None, etype=None, pscrn=None, device=None,
+                 kernel=None, invks=False, taps=None, invkstaps=3, a1=None, a2=None, chromak_up=None, chromak_up_taps=None, chromak_up_a1=None, chromak_up_a2=None, chromak_down=None, chromak_down_invks=False, chromak_down_invkstaps=3, chromak_down_taps=None, chromak_down_a1=None, chromak_down_a2=None,
+                 fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None,stackuv=False,sample=None):
+        core = vs.get_core()
+        funcName = 'nnedi3_resample'
+        
+        sFormat = core.get_format(format)
+        
+        sColorFamily = sFormat.color_family
+        if sColorFamily == vs.COMPAT:
+            raise ValueError(funcName + ': Color family *COMPAT* of input clip is not supported!')
+        sIsGRAY = sColorFamily == vs.GRAY
+        sIsYUV = sColorFamily == vs.YUV or sColorFamily == vs.YCOCG
+        sIsRGB = sColorFamily == vs.RGB
+        
+        sbitPS = sFormat.bits_per_sample
+        
+        sHSubS = 1 << sFormat.subsampling_w
+        sVSubS = 1 << sFormat.subsampling_h
+        sIsSubS = sHSubS > 1 or sVSubS > 1
+        
+        sPlaneNum = sFormat.num_planes
+        
+        # Get property about output clip
+        dFormat = sFormat if csp is None else core.get_format(csp)
+        
+        dColorFamily = dFormat.color_family
+        if dColorFamily == vs.COMPAT:
+            raise ValueError(funcName + ': Color family *COMPAT* of output clip is not supported!')
+        dIsGRAY = dColorFamily == vs.GRAY
+        dIsYUV = dColorFamily == vs.YUV or dColorFamily == vs.YCOCG
+        dIsRGB = dColorFamily == vs.RGB
+        
+        dbitPS = dFormat.bits_per_sample
+        
+        dHSubS = 1 << dFormat.subsampling_w
+        dVSubS = 1 << dFormat.subsampling_h
+        dIsSubS = dHSubS > 1 or dVSubS > 1
+        
+        dPlaneNum = dFormat.num_planes
+        
+        # Parameters of format
+        SD = width <= 1024 and height <= 576
+        HD = width <= 2048 and height <= 1536
+        
+        if mats is None:
+            mats = "601" if SD else "709" if HD else "2020"
+        else:
+            mats = mats.lower()
+        if matd is None:
             matd = mats
-        # Matrix of input clip makes sense only src is not of GRAY or RGB
-        if sIsGRAY or sIsRGB:
-            mats = matd
-    if cplaces is None:
-        if sHSubS == 4:
-            cplaces = 'dv'
         else:
-            cplaces = 'mpeg2'
-    else:
-        cplaces = cplaces.lower()
-    if cplaced is None:
-        if dHSubS == 4:
-            cplaced = 'dv'
+            matd = matd.lower()
+            # Matrix of output clip makes sense only if dst is not of RGB
+            if dIsRGB:
+                matd = mats
+            # Matrix of input clip makes sense only src is not of GRAY or RGB
+            if sIsGRAY or sIsRGB:
+                mats = matd
+        if cplaces is None:
+            if sHSubS == 4:
+                cplaces = 'dv'
+            else:
+                cplaces = 'mpeg2'
         else:
-            cplaced = cplaces
-    else:
-        cplaced = cplaced.lower()
-    if fulls is None:
-        fulls = sColorFamily == vs.YCOCG or sColorFamily == vs.RGB
-    if fulld is None:
-        if dColorFamily == sColorFamily:
-            fulld = fulls
+            cplaces = cplaces.lower()
+        if cplaced is None:
+            if dHSubS == 4:
+                cplaced = 'dv'
+            else:
+                cplaced = cplaces
         else:
-            fulld = dColorFamily == vs.YCOCG or dColorFamily == vs.RGB
-    if curves is None:
-        curves = 'linear'
-    else:
-        curves = curves.lower()
-    if curved is None:
-        curved = curves
-    else:
-        curved = curved.lower()
-    if sigmoid is None:
-        sigmoid = False
-    
-    # Parameters of scaling
-    if target_width is None:
-        target_width = input.width
-    if target_height is None:
-        target_height = input.height
-    if src_left is None:
-        src_left = 0
-    if src_top is None:
-        src_top = 0
-    if src_width is None:
-        src_width = input.width
-    elif src_width <= 0:
-        src_width = input.width - src_left + src_width
-    if src_height is None:
-        src_height = input.height
-    elif src_height <= 0:
-        src_height = input.height - src_top + src_height
-    if scale_thr is None:
-        scale_thr = 1.125
-    
-    src_right = src_width - input.width + src_left
-    src_bottom = src_height - input.height + src_top
-    
-    hScale = target_width / src_width
-    vScale = target_height / src_height
-    
-    # Parameters of nnedi3
-    if nsize is None:
-        nsize = 0
-    if nns is None:
-        nns = 3
-    if qual is None:
-        qual = 2
-    
-    # Parameters of fmtc.resample
-    if kernel is None:
-        if not invks:
-            kernel = 'spline36'
+            cplaced = cplaced.lower()
+        if fulls is None:
+            fulls = sColorFamily == vs.YCOCG or sColorFamily == vs.RGB
+        sFulls = fulls
+        if fulld is None:
+            if dColorFamily == sColorFamily:
+                fulld = fulls
+            else:
+                fulld = dColorFamily == vs.YCOCG or dColorFamily == vs.RGB
+        if curves is None:
+            curves = 'linear'
         else:
-            kernel = 'bilinear'
-    else:
-        kernel = kernel.lower()
-    if chromak_up is None:
-        chromak_up = 'nnedi3'
-    else:
-        chromak_up = chromak_up.lower()
-    if chromak_up == 'softcubic':
-        chromak_up = 'bicubic'
-        if chromak_up_a1 is None:
-            chromak_up_a1 = 75
-        chromak_up_a1 = chromak_up_a1 / 100
-        chromak_up_a2 = 1 - chromak_up_a1
-    if chromak_down is None:
-        chromak_down = 'bicubic'
-    else:
-        chromak_down = chromak_down.lower()
-    if chromak_down == 'softcubic':
-        chromak_down = 'bicubic'
-        if chromak_down_a1 is None:
-            chromak_down_a1 = 75
-        chromak_down_a1 = chromak_down_a1 / 100
-        chromak_down_a2 = 1 - chromak_down_a1
-    
-    # Procedure decision
-    hIsScale = hScale != 1
-    vIsScale = vScale != 1
-    isScale = hIsScale or vIsScale
-    hResample = hIsScale or int(src_left) != src_left or int(src_right) != src_right
-    vResample = vIsScale or int(src_top) != src_top or int(src_bottom) != src_bottom
-    resample = hResample or vResample
-    hReSubS = dHSubS != sHSubS
-    vReSubS = dVSubS != sVSubS
-    reSubS = hReSubS or vReSubS
-    sigmoid = sigmoid and resample
-    sGammaConv = curves != 'linear'
-    dGammaConv = curved != 'linear'
-    gammaConv = (sGammaConv or dGammaConv or sigmoid) and (resample or curved != curves)
-    scaleInGRAY = sIsGRAY or dIsGRAY
-    scaleInYUV = not scaleInGRAY and mats == matd and not gammaConv and (reSubS or (sIsYUV and dIsYUV))
-    scaleInRGB = not scaleInGRAY and not scaleInYUV
-    # If matrix conversion or gamma correction is applied, scaling will be done in RGB. Otherwise, if at least one of input&output clip is RGB and no chroma subsampling is involved, scaling will be done in RGB.
-    
-    # Chroma placement relative to the frame center in luma scale
-    sCLeftAlign = cplaces == 'mpeg2' or cplaces == 'dv'
-    sHCPlace = 0 if not sCLeftAlign else 0.5 - sHSubS / 2
-    sVCPlace = 0
-    dCLeftAlign = cplaced == 'mpeg2' or cplaced == 'dv'
-    dHCPlace = 0 if not dCLeftAlign else 0.5 - dHSubS / 2
-    dVCPlace = 0
-    
-    # Convert depth to 16-bit
-    last = mvf.Depth(input, depth=16, fulls=fulls)
-    
-    # Color space conversion before scaling
-    if scaleInGRAY and sIsYUV:
-        if mats != matd:
-            last = core.fmtc.matrix(last, mats=mats, matd=matd, fulls=fulls, fulld=fulld, col_fam=vs.GRAY, singleout=0)
-        last = core.std.ShufflePlanes(last, [0], vs.GRAY)
-    elif scaleInGRAY and sIsRGB:
-        # Matrix conversion for output clip of GRAY
-        last = core.fmtc.matrix(last, mat=matd, fulls=fulls, fulld=fulld, col_fam=vs.GRAY, singleout=0)
-        fulls = fulld
-    elif scaleInRGB and sIsYUV:
-        # Chroma upsampling
-        if sIsSubS:
-            if chromak_up == 'nnedi3':
+            curves = curves.lower()
+        if curved is None:
+            curved = curves
+        else:
+            curved = curved.lower()
+        if sigmoid is None:
+            sigmoid = False
+        
+        # Parameters of scaling
+        if target_width is None:
+            target_width = width
+        if target_height is None:
+            target_height = height
+        if src_left is None:
+            src_left = 0
+        if src_top is None:
+            src_top = 0
+        if src_width is None:
+            src_width = width
+        elif src_width <= 0:
+            src_width = width - src_left + src_width
+        if src_height is None:
+            src_height = height
+        elif src_height <= 0:
+            src_height = height - src_top + src_height
+        if scale_thr is None:
+            scale_thr = 1.125
+        
+        src_right = src_width - width + src_left
+        src_bottom = src_height - height + src_top
+        
+        hScale = target_width / src_width
+        vScale = target_height / src_height
+        
+        # Parameters of nnedi3
+        if nsize is None:
+            nsize = 0
+        if nns is None:
+            nns = 3
+        if qual is None:
+            qual = 2
+        
+        # Parameters of fmtc.resample
+        if kernel is None:
+            if not invks:
+                kernel = 'spline36'
+            else:
+                kernel = 'bilinear'
+        else:
+            kernel = kernel.lower()
+        if chromak_up is None:
+            chromak_up = 'nnedi3'
+        else:
+            chromak_up = chromak_up.lower()
+        if chromak_up == 'softcubic':
+            chromak_up = 'bicubic'
+            if chromak_up_a1 is None:
+                chromak_up_a1 = 75
+            chromak_up_a1 = chromak_up_a1 / 100
+            chromak_up_a2 = 1 - chromak_up_a1
+        if chromak_down is None:
+            chromak_down = 'bicubic'
+        else:
+            chromak_down = chromak_down.lower()
+        if chromak_down == 'softcubic':
+            chromak_down = 'bicubic'
+            if chromak_down_a1 is None:
+                chromak_down_a1 = 75
+            chromak_down_a1 = chromak_down_a1 / 100
+            chromak_down_a2 = 1 - chromak_down_a1
+        
+        # Procedure decision
+        hIsScale = hScale != 1
+        vIsScale = vScale != 1
+        isScale = hIsScale or vIsScale
+        # A crop reaching outside the frame needs the edge padding of fmtc.resample
+        hResample = hIsScale or int(src_left) != src_left or int(src_right) != src_right or src_left < 0 or src_right > 0
+        vResample = vIsScale or int(src_top) != src_top or int(src_bottom) != src_bottom or src_top < 0 or src_bottom > 0
+        # Otherwise an integer crop at unchanged scale is a std.CropAbs on the input if it keeps the chroma aligned
+        sWidth, sHeight = width, height
+        crop = None
+        if not hResample and not vResample and (src_left, src_top, src_right, src_bottom) != (0, 0, 0, 0) and src_left % sHSubS == 0 and src_right % sHSubS == 0 and src_top % sVSubS == 0 and src_bottom % sVSubS == 0:
+            crop = (int(src_width), int(src_height), int(src_left), int(src_top))
+            width, height = crop[:2]
+            src_left = src_top = src_right = src_bottom = 0
+        # What is left of the crop is done by nnedi3_resample_kernel
+        cropped = (src_left, src_top, src_right, src_bottom) != (0, 0, 0, 0)
+        resample = hResample or vResample
+        hReSubS = dHSubS != sHSubS
+        vReSubS = dVSubS != sVSubS
+        reSubS = hReSubS or vReSubS
+        sigmoid = sigmoid and resample
+        sGammaConv = curves != 'linear'
+        dGammaConv = curved != 'linear'
+        gammaConv = (sGammaConv or dGammaConv or sigmoid) and (resample or curved != curves)
+        scaleInGRAY = sIsGRAY or dIsGRAY
+        scaleInYUV = not scaleInGRAY and mats == matd and not gammaConv and (reSubS or (sIsYUV and dIsYUV))
+        scaleInRGB = not scaleInGRAY and not scaleInYUV
+        # If matrix conversion or gamma correction is applied, scaling will be done in RGB. Otherwise, if at least one of input&output clip is RGB and no chroma subsampling is involved, scaling will be done in RGB.
+        
+        # Chroma placement relative to the frame center in luma scale
+        sCLeftAlign = cplaces == 'mpeg2' or cplaces == 'dv'
+        sHCPlace = 0 if not sCLeftAlign else 0.5 - sHSubS / 2
+        sVCPlace = 0
+        dCLeftAlign = cplaced == 'mpeg2' or cplaced == 'dv'
+        dHCPlace = 0 if not dCLeftAlign else 0.5 - dHSubS / 2
+        dVCPlace = 0
+        
+        # Transfer curves applied before and after scaling, as steps of one LUT each
+        sTransfer = _gamma_steps(False, curves, sigmoid=sigmoid) if gammaConv and sGammaConv else (('sinv', 0.5, 6.5),) if sigmoid else ()
+        dTransfer = _gamma_steps(True, curved, sigmoid=sigmoid) if gammaConv and dGammaConv else (('sdir', 0.5, 6.5),) if sigmoid else ()
+        # The depth conversion is left to the first LUT if nothing runs in between
+        # Working format: 16-bit integer, or 32-bit float where every intermediate clip is full range
+        if sample is None:
+            sample = sFormat.sample_type
+        flt = sample == vs.FLOAT
+        wName = 'float' if flt else '16-bit'
+        mfulld = True if flt else fulld
+        # Gamma curves normalize with the clip range, sigmoid-only steps always as full range like SigmoidInverse/SigmoidDirect
+        sSigmoidOnly = not (gammaConv and sGammaConv)
+        dSigmoidOnly = not (gammaConv and dGammaConv)
+        fuseDepth = not flt and sTransfer and (fulls or not sSigmoidOnly) and sFormat.sample_type == vs.INTEGER and sbitPS <= 16 and ((scaleInRGB and sIsRGB) or (scaleInGRAY and sIsGRAY))
+        
+        # Keyword arguments shared by the nnedi3_resample_kernel calls
+        nnArgs = dict(nsize=nsize, nns=nns, qual=qual, etype=etype, pscrn=pscrn, device=device, kernel=kernel, taps=taps, a1=a1, a2=a2, fast=fast, flat_kernel=flat_kernel, flat_a1=flat_a1, flat_a2=flat_a2, flat_taps=flat_taps)
+        
+        self.format = sFormat
+        self.width = sWidth
+        self.height = sHeight
+        self.dFormat = dFormat
+        self.target_width = target_width
+        self.target_height = target_height
+        self.stages = []
+        add = lambda name, cost, func: self.stages.append((name, cost, func))
+        area = width * height
+        dArea = target_width * target_height
+        
+        if crop is not None:
+            add('std.CropAbs %dx%d+%d+%d' % crop, 0, lambda core, last: core.std.CropAbs(last, *crop))
+        
+        # Convert depth to 16-bit or float
+        if flt:
+            if sFormat.sample_type != vs.FLOAT or sbitPS != 32:
+                add('mvf.Depth %d-bit -> float' % sbitPS, _plane_pixels(sFormat, width, height), lambda core, last, fulls=fulls: mvf.Depth(last, depth=32, sample=vs.FLOAT, fulls=fulls))
+            fulls = True
+        elif not fuseDepth and (sFormat.sample_type != vs.INTEGER or sbitPS != 16):
+            add('mvf.Depth %d-bit -> 16-bit' % sbitPS, _plane_pixels(sFormat, width, height), lambda core, last, fulls=fulls: mvf.Depth(last, depth=16, fulls=fulls))
+        
+        # Output depth conversion, not needed if the working format already is the output one
+        def depth_out(cost, **args):
+            if dFormat.sample_type == sample and dbitPS == (32 if flt else 16) and (flt or args['fulls'] == args.get('fulld', args['fulls'])):
+                return
+            if flt:
+                args['sample'] = dFormat.sample_type
+            add('mvf.Depth %s -> %d-bit' % (wName, dbitPS), cost, lambda core, last: mvf.Depth(last, depth=dbitPS, **args))
+        
+        # Color space conversion before scaling
+        if scaleInGRAY and sIsYUV:
+            if mats != matd:
+                add('fmtc.matrix %s -> %s' % (mats, matd), area, lambda core, last, fulls=fulls: core.fmtc.matrix(last, mats=mats, matd=matd, fulls=fulls, fulld=mfulld, col_fam=vs.GRAY, singleout=0))
+            add('std.ShufflePlanes Y', 0, lambda core, last: core.std.ShufflePlanes(last, [0], vs.GRAY))
+        elif scaleInGRAY and sIsRGB:
+            # Matrix conversion for output clip of GRAY
+            add('fmtc.matrix RGB -> GRAY %s' % matd, area, lambda core, last, fulls=fulls: core.fmtc.matrix(last, mat=matd, fulls=fulls, fulld=mfulld, col_fam=vs.GRAY, singleout=0))
+            fulls = mfulld
+        elif scaleInRGB and sIsYUV:
+            # Chroma upsampling
+            if sIsSubS:
+                if chromak_up == 'nnedi3':
+                    def chroma_up(core, last):
+                        # Separate planes
+                        Y = core.std.ShufflePlanes(last, [0], vs.GRAY)
+                        U = core.std.ShufflePlanes(last, [1], vs.GRAY)
+                        V = core.std.ShufflePlanes(last, [2], vs.GRAY)
+                        # Chroma up-scaling
+                        uvKernel = lambda clip, w, h, sx, sy, sw, sh: nnedi3_resample_kernel(clip, w, h, sx, sy, sw, sh, 1, **nnArgs)
+                        UV = _stackuv_kernel(U, V, width, height, -sHCPlace / sHSubS, -sVCPlace / sVSubS, U.width, U.height, uvKernel, taps, nsize) if stackuv else None
+                        if UV is None:
+                            U = uvKernel(U, width, height, -sHCPlace / sHSubS, -sVCPlace / sVSubS, None, None)
+                            V = uvKernel(V, width, height, -sHCPlace / sHSubS, -sVCPlace / sVSubS, None, None)
+                        else:
+                            U, V = UV
+                        # Merge planes
+                        return core.std.ShufflePlanes([Y, U, V], [0, 0, 0], last.format.color_family)
+                    cost = 2 * _kernel_cost(width // sHSubS, height // sVSubS, width, height, sHSubS, sVSubS, 1, sHSubS > 1 or sHCPlace != 0, sVSubS > 1)
+                    add('nnedi3_resample_kernel U, V -> 444', cost, chroma_up)
+                else:
+                    add('fmtc.resample %s -> 444' % chromak_up, 3 * area, lambda core, last, fulls=fulls: core.fmtc.resample(last, kernel=chromak_up, taps=chromak_up_taps, a1=chromak_up_a1, a2=chromak_up_a2, css="444", fulls=fulls, cplaces=cplaces))
+            # Matrix conversion
+            if mats == '2020cl':
+                add('fmtc.matrix2020cl YUV -> RGB', 3 * area, lambda core, last, fulls=fulls: core.fmtc.matrix2020cl(last, fulls))
+            else:
+                add('fmtc.matrix %s YUV -> RGB' % mats, 3 * area, lambda core, last, fulls=fulls: core.fmtc.matrix(last, mat=mats, fulls=fulls, fulld=True, col_fam=vs.RGB, singleout=-1))
+            fulls = True
+        elif scaleInYUV and sIsRGB:
+            # Matrix conversion
+            if matd == '2020cl':
+                add('fmtc.matrix2020cl RGB -> YUV', 3 * area, lambda core, last: core.fmtc.matrix2020cl(last, mfulld))
+            else:
+                add('fmtc.matrix RGB -> %s YUV' % matd, 3 * area, lambda core, last, fulls=fulls: core.fmtc.matrix(last, mat=matd, fulls=fulls, fulld=mfulld, col_fam=vs.YUV, singleout=-1))
+            fulls = mfulld
+        
+        # Scaling
+        if scaleInGRAY or scaleInRGB:
+            planes = 1 if scaleInGRAY else 3
+            sFull = True if sSigmoidOnly else fulls
+            dFull = True if dSigmoidOnly else fulls
+            tFull = sFull
+            transfer = sTransfer
+            if resample or (dTransfer and sFull != dFull):
+                if transfer:
+                    add(('std.Expr ' if flt else 'std.Lut ') + _steps_name(transfer), planes * area, lambda core, last, transfer=transfer, sFull=sFull: _transfer(last, transfer, sFull, sFull))
+                    transfer = ()
+            if resample or cropped:
+                cost = planes * _kernel_cost(width, height, target_width, target_height, hScale, vScale, scale_thr, hResample, vResample)
+                add('nnedi3_resample_kernel %dx%d -> %dx%d' % (width, height, target_width, target_height), cost, lambda core, last: nnedi3_resample_kernel(last, target_width, target_height, src_left, src_top, src_width, src_height, scale_thr, invks=invks, invkstaps=invkstaps, **nnArgs))
+            # Without scaling in between, the forward and backward curves are composed into one LUT if they normalize the same way
+            if dTransfer:
+                transfer += dTransfer
+                tFull = dFull
+            if transfer:
+                add(('std.Expr ' if flt else 'std.Lut ') + _steps_name(transfer), planes * dArea, lambda core, last, transfer=transfer, tFull=tFull: _transfer(last, transfer, tFull, tFull))
+        elif scaleInYUV and not sIsSubS and not dIsSubS:
+            # Chroma has the same geometry as luma, scale all planes at once
+            if resample or cropped:
+                cost = 3 * _kernel_cost(width, height, target_width, target_height, hScale, vScale, scale_thr, hResample, vResample)
+                add('nnedi3_resample_kernel YUV444 %dx%d -> %dx%d' % (width, height, target_width, target_height), cost, lambda core, last: nnedi3_resample_kernel(last, target_width, target_height, src_left, src_top, src_width, src_height, scale_thr, **nnArgs))
+        elif scaleInYUV:
+            # Scale UV
+            dCw = target_width // dHSubS
+            dCh = target_height // dVSubS
+            dCsx = ((src_left - sHCPlace) * hScale + dHCPlace) / hScale / sHSubS
+            dCsy = ((src_top - sVCPlace) * vScale + dVCPlace) / vScale / sVSubS
+            dCsw = src_width / sHSubS
+            dCsh = src_height / sVSubS
+            cHResample = _resamples(width // sHSubS, dCw, dCsx, dCsw)
+            cVResample = _resamples(height // sVSubS, dCh, dCsy, dCsh)
+            def scale_yuv(core, last):
                 # Separate planes
                 Y = core.std.ShufflePlanes(last, [0], vs.GRAY)
                 U = core.std.ShufflePlanes(last, [1], vs.GRAY)
                 V = core.std.ShufflePlanes(last, [2], vs.GRAY)
-                # Chroma up-scaling
-                U = nnedi3_resample_kernel(U, Y.width, Y.height, -sHCPlace / sHSubS, -sVCPlace / sVSubS, None, None, 1, nsize, nns, qual, etype, pscrn, device, kernel, taps, a1, a2, fast=fast, flat_kernel=flat_kernel,flat_a1=flat_a1,flat_a2=flat_a2,flat_taps=flat_taps)
-                V = nnedi3_resample_kernel(V, Y.width, Y.height, -sHCPlace / sHSubS, -sVCPlace / sVSubS, None, None, 1, nsize, nns, qual, etype, pscrn, device, kernel, taps, a1, a2, fast=fast, flat_kernel=flat_kernel,flat_a1=flat_a1,flat_a2=flat_a2,flat_taps=flat_taps)
+                # Scale Y
+                Y = nnedi3_resample_kernel(Y, target_width, target_height, src_left, src_top, src_width, src_height, scale_thr, **nnArgs)
+                # Scale UV
+                uvKernel = lambda clip, w, h, sx, sy, sw, sh: nnedi3_resample_kernel(clip, w, h, sx, sy, sw, sh, scale_thr, **nnArgs)
+                UV = _stackuv_kernel(U, V, dCw, dCh, dCsx, dCsy, dCsw, dCsh, uvKernel, taps, nsize) if stackuv else None
+                if UV is None:
+                    U = uvKernel(U, dCw, dCh, dCsx, dCsy, dCsw, dCsh)
+                    V = uvKernel(V, dCw, dCh, dCsx, dCsy, dCsw, dCsh)
+                else:
+                    U, V = UV
                 # Merge planes
-                last = core.std.ShufflePlanes([Y, U, V], [0, 0, 0], last.format.color_family)
+                return core.std.ShufflePlanes([Y, U, V], [0, 0, 0], last.format.color_family)
+            # Splitting and merging the planes is skipped if no plane changes
+            if resample or cropped or cHResample or cVResample:
+                cost = _kernel_cost(width, height, target_width, target_height, hScale, vScale, scale_thr, hResample, vResample)
+                cost += 2 * _kernel_cost(width // sHSubS, height // sVSubS, dCw, dCh, hScale, vScale, scale_thr, cHResample, cVResample)
+                add('nnedi3_resample_kernel Y, U, V %dx%d -> %dx%d' % (width, height, target_width, target_height), cost, scale_yuv)
+        
+        # Color space conversion after scaling
+        if scaleInGRAY and dIsYUV:
+            dCw = target_width // dHSubS
+            dCh = target_height // dVSubS
+            depth_out(dArea, fulls=fulls, fulld=fulld)
+            def gray_to_yuv(core, last):
+                blkUV = core.std.BlankClip(last, dCw, dCh, color=[0 if last.format.sample_type == vs.FLOAT else 1 << (last.format.bits_per_sample - 1)])
+                return core.std.ShufflePlanes([last, blkUV, blkUV], [0, 0, 0], dColorFamily)
+            add('std.BlankClip UV', 0, gray_to_yuv)
+        elif scaleInGRAY and dIsRGB:
+            depth_out(dArea, fulls=fulls, fulld=fulld)
+            add('std.ShufflePlanes GRAY -> RGB', 0, lambda core, last: core.std.ShufflePlanes([last, last, last], [0, 0, 0], dColorFamily))
+        elif scaleInRGB and dIsYUV:
+            # Matrix conversion
+            if matd == '2020cl':
+                add('fmtc.matrix2020cl RGB -> YUV', 3 * dArea, lambda core, last: core.fmtc.matrix2020cl(last, mfulld))
             else:
-                last = core.fmtc.resample(last, kernel=chromak_up, taps=chromak_up_taps, a1=chromak_up_a1, a2=chromak_up_a2, css="444", fulls=fulls, cplaces=cplaces)
-        # Matrix conversion
-        if mats == '2020cl':
-            last = core.fmtc.matrix2020cl(last, fulls)
-        else:
-            last = core.fmtc.matrix(last, mat=mats, fulls=fulls, fulld=True, col_fam=vs.RGB, singleout=-1)
-        fulls = True
-    elif scaleInYUV and sIsRGB:
-        # Matrix conversion
-        if matd == '2020cl':
-            last = core.fmtc.matrix2020cl(last, fulld)
+                add('fmtc.matrix RGB -> %s YUV' % matd, 3 * dArea, lambda core, last, fulls=fulls: core.fmtc.matrix(last, mat=matd, fulls=fulls, fulld=mfulld, col_fam=dColorFamily, singleout=-1))
+            # Chroma subsampling
+            if dIsSubS:
+                dCSS = '411' if dHSubS == 4 else '420' if dVSubS == 2 else '422'
+                add('fmtc.resample %s -> %s' % (chromak_down, dCSS), 2 * dArea // (dHSubS * dVSubS), lambda core, last: core.fmtc.resample(last, kernel=chromak_down, taps=chromak_down_taps, a1=chromak_down_a1, a2=chromak_down_a2, css=dCSS, fulls=mfulld, cplaced=cplaced, invks=chromak_down_invks, invkstaps=chromak_down_invkstaps, planes=[2,3,3]))
+            depth_out(_plane_pixels(dFormat, target_width, target_height), fulls=mfulld, fulld=fulld)
+        elif scaleInYUV and dIsRGB:
+            # Matrix conversion
+            if mats == '2020cl':
+                add('fmtc.matrix2020cl YUV -> RGB', 3 * dArea, lambda core, last, fulls=fulls: core.fmtc.matrix2020cl(last, fulls))
+            else:
+                add('fmtc.matrix %s YUV -> RGB' % mats, 3 * dArea, lambda core, last, fulls=fulls: core.fmtc.matrix(last, mat=mats, fulls=fulls, fulld=True, col_fam=vs.RGB, singleout=-1))
+            depth_out(_plane_pixels(dFormat, target_width, target_height), fulls=True, fulld=fulld)
         else:
-            last = core.fmtc.matrix(last, mat=matd, fulls=fulls, fulld=fulld, col_fam=vs.YUV, singleout=-1)
-        fulls = fulld
+            depth_out(_plane_pixels(dFormat, target_width, target_height), fulls=fulls, fulld=fulld)
+        
+        # With nothing but the crop in between, converting the depth and back again changes nothing
+        if dFormat.id == sFormat.id and sFulls == fulld and all(name.startswith(('std.CropAbs', 'mvf.Depth')) for name, cost, func in self.stages):
+            self.stages = [stage for stage in self.stages if not stage[0].startswith('mvf.Depth')]
+    
+    def __call__(self, input):
+        if not isinstance(input, vs.VideoNode):
+            raise TypeError('nnedi3_resample: This is not a clip!')
+        if input.format.id != self.format.id or input.width != self.width or input.height != self.height:
+            raise ValueError('nnedi3_resample: the clip doesn\'t match the format or size of the plan!')
+        
+        core = vs.get_core()
+        last = input
+        for name, cost, func in self.stages:
+            last = func(core, last)
+        return last
     
-    # Scaling
-    if scaleInGRAY or scaleInRGB:
-        if gammaConv and sGammaConv:
-            last = GammaToLinear(last, fulls, fulls, curves, sigmoid=sigmoid)
-        elif sigmoid:
-            last = SigmoidInverse(last)
-        last = nnedi3_resample_kernel(last, target_width, target_height, src_left, src_top, src_width, src_height, scale_thr, nsize, nns, qual, etype, pscrn, device, kernel, taps, a1, a2, invks, invkstaps, fast=fast,flat_kernel=flat_kernel,flat_a1=flat_a1,flat_a2=flat_a2,flat_taps=flat_taps)
-        if gammaConv and dGammaConv:
-            last = LinearToGamma(last, fulls, fulls, curved, sigmoid=sigmoid)
-        elif sigmoid:
-            last = SigmoidDirect(last)
-    elif scaleInYUV:
-        # Separate planes
-        Y = core.std.ShufflePlanes(last, [0], vs.GRAY)
-        U = core.std.ShufflePlanes(last, [1], vs.GRAY)
-        V = core.std.ShufflePlanes(last, [2], vs.GRAY)
-        # Scale Y
-        Y = nnedi3_resample_kernel(Y, target_width, target_height, src_left, src_top, src_width, src_height, scale_thr, nsize, nns, qual, etype, pscrn, device, kernel, taps, a1, a2, fast=fast,flat_kernel=flat_kernel,flat_a1=flat_a1,flat_a2=flat_a2,flat_taps=flat_taps)
-        # Scale UV
-        dCw = target_width // dHSubS
-        dCh = target_height // dVSubS
-        dCsx = ((src_left - sHCPlace) * hScale + dHCPlace) / hScale / sHSubS
-        dCsy = ((src_top - sVCPlace) * vScale + dVCPlace) / vScale / sVSubS
-        dCsw = src_width / sHSubS
-        dCsh = src_height / sVSubS
-        U = nnedi3_resample_kernel(U, dCw, dCh, dCsx, dCsy, dCsw, dCsh, scale_thr, nsize, nns, qual, etype, pscrn, device, kernel, taps, a1, a2, fast=fast,flat_kernel=flat_kernel,flat_a1=flat_a1,flat_a2=flat_a2,flat_taps=flat_taps)
-        V = nnedi3_resample_kernel(V, dCw, dCh, dCsx, dCsy, dCsw, dCsh, scale_thr, nsize, nns, qual, etype, pscrn, device, kernel, taps, a1, a2, fast=fast,flat_kernel=flat_kernel,flat_a1=flat_a1,flat_a2=flat_a2,flat_taps=flat_taps)
-        # Merge planes
-        last = core.std.ShufflePlanes([Y, U, V], [0, 0, 0], last.format.color_family)
-    
-    # Color space conversion after scaling
-    if scaleInGRAY and dIsYUV:
-        dCw = target_width // dHSubS
-        dCh = target_height // dVSubS
-        last = mvf.Depth(last, depth=dbitPS, fulls=fulls, fulld=fulld)
-        blkUV = core.std.BlankClip(last, dCw, dCh, color=[1 << (dbitPS - 1)])
-        last = core.std.ShufflePlanes([last, blkUV, blkUV], [0, 0, 0], dColorFamily)
-    elif scaleInGRAY and dIsRGB:
-        last = mvf.Depth(last, depth=dbitPS, fulls=fulls, fulld=fulld)
-        last = core.std.ShufflePlanes([last, last, last], [0, 0, 0], dColorFamily)
-    elif scaleInRGB and dIsYUV:
-        # Matrix conversion
-        if matd == '2020cl':
-            last = core.fmtc.matrix2020cl(last, fulld)
-        else:
-            last = core.fmtc.matrix(last, mat=matd, fulls=fulls, fulld=fulld, col_fam=dColorFamily, singleout=-1)
-        # Chroma subsampling
-        if dIsSubS:
-            dCSS = '411' if dHSubS == 4 else '420' if dVSubS == 2 else '422'
-            last = core.fmtc.resample(last, kernel=chromak_down, taps=chromak_down_taps, a1=chromak_down_a1, a2=chromak_down_a2, css=dCSS, fulls=fulld, cplaced=cplaced, invks=chromak_down_invks, invkstaps=chromak_down_invkstaps, planes=[2,3,3])
-        last = mvf.Depth(last, depth=dbitPS, fulls=fulld)
-    elif scaleInYUV and dIsRGB:
-        # Matrix conversion
-        if mats == '2020cl':
-            last = core.fmtc.matrix2020cl(last, fulls)
-        else:
-            last = core.fmtc.matrix(last, mat=mats, fulls=fulls, fulld=True, col_fam=vs.RGB, singleout=-1)
-        last = mvf.Depth(last, depth=dbitPS, fulls=True, fulld=fulld)
-    else:
-        last = mvf.Depth(last, depth=dbitPS, fulls=fulls, fulld=fulld)
+    # Cost is the number of plane pixels written per frame, nnedi3 doublings and transposes included
+    def explain(self):
+        lines = ['%s %dx%d -> %s %dx%d' % (self.format.name, self.width, self.height, self.dFormat.name, self.target_width, self.target_height)]
+        for i, (name, cost, func) in enumerate(self.stages, 1):
+            lines.append('%2d. %-56s %8.2f MP' % (i, name, cost / 1e6))
+        lines.append('    %-56s %8.2f MP' % ('total', sum(cost for name, cost, func in self.stages) / 1e6))
+        return '\n'.join(lines)
+
+
+# Whether nnedi3_resample_kernel changes a plane in one direction
+def _resamples(size, target, src_pos, src_size):
+    src_end = src_size - size + src_pos
+    return target / src_size != 1 or int(src_pos) != src_pos or int(src_end) != src_end
+
+
+def _plane_pixels(format, width, height):
+    return width * height + (format.num_planes - 1) * (width >> format.subsampling_w) * (height >> format.subsampling_h)
+
+
+def _steps_name(steps):
+    return ' '.join('%s(%s)' % (step[0], ', '.join(str(x) for x in step[1:])) for step in steps)
+
+
+# Plane pixels written by nnedi3_resample_kernel, see ResamplePlan.explain
+def _kernel_cost(width, height, target_width, target_height, hScale, vScale, scale_thr, hResample=True, vResample=True, tpre=False, tpost=False):
+    cost = 0
+    w, h = width, height
+    if hResample:
+        if tpre:
+            cost += w * h
+        for i in range(math.ceil(math.log(hScale / scale_thr, 2)) if hScale > scale_thr else 0):
+            w *= 2
+            cost += w * h
+        w = target_width
+        cost += w * h
+        if tpost:
+            cost += w * h
+    if vResample:
+        for i in range(math.ceil(math.log(vScale / scale_thr, 2)) if vScale > scale_thr else 0):
+            h *= 2
+            cost += w * h
+        h = target_height
+        cost += w * h
+    return cost
+
+
+# Scale U and V with one kernel chain: V is placed to the right of U with a mirrored gap,
+# whose width is chosen so that V starts at an integer position in the output and the kernels don't reach across.
+# Returns None if no such gap fits.
+def _stackuv_kernel(U, V, target_width, target_height, src_left, src_top, src_width, src_height, kernel, taps=None, nsize=0):
+    core = vs.get_core()
     
-    # Output
-    return last
+    w = U.width
+    hScale = Fraction(target_width) / Fraction(src_width)
+    # The gap covers the width of the nnedi3 predictor window plus the fmtc kernel support
+    nnWidth = (8, 16, 32, 48, 8, 16, 32)[nsize]
+    pad = math.ceil((nnWidth + max(16, 2 * (taps or 4))) / min(hScale, 1))
+    
+    # Distance between the left edges of U and V in the stacked plane
+    dist = -(-(w + 2 * pad) // hScale.denominator) * hScale.denominator
+    gapU = (dist - w) // 2
+    gapV = dist - w - gapU
+    if gapU > w or gapV > w:
+        return None
+    
+    last = core.std.StackHorizontal([U, core.std.FlipHorizontal(core.std.Crop(U, left=w - gapU)), core.std.FlipHorizontal(core.std.Crop(V, right=w - gapV)), V])
+    last = kernel(last, int(target_width + dist * hScale), target_height, src_left, src_top, src_width + dist, src_height)
+    
+    return core.std.CropAbs(last, target_width, target_height, 0, 0), core.std.CropAbs(last, target_width, target_height, int(dist * hScale), 0)
 
 
 def nnedi3_resample_kernel(input, target_width=None, target_height=None, src_left=None, src_top=None, src_width=None, src_height=None, scale_thr=None, nsize=None, nns=None, qual=None, etype=None, pscrn=None, device=None, kernel=None, taps=None, a1=None, a2=None, invks=False, invkstaps=3, fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None):
@@ -353,17 +564,22 @@ def nnedi3_resample_kernel(input, target_width=None, target_height=None, src_lef
     hIsScale = hScale != 1
     vIsScale = vScale != 1
     isScale = hIsScale or vIsScale
-    hResample = hIsScale or int(src_left) != src_left or int(src_right) != src_right
-    vResample = vIsScale or int(src_top) != src_top or int(src_bottom) != src_bottom
+    # A crop reaching outside the frame needs the edge padding of fmtc.resample
+    hResample = hIsScale or int(src_left) != src_left or int(src_right) != src_right or src_left < 0 or src_right > 0
+    vResample = vIsScale or int(src_top) != src_top or int(src_bottom) != src_bottom or src_top < 0 or src_bottom > 0
     resample = hResample or vResample
     
     # Scaling
     last = input
     
+    # An integer crop at unchanged scale is taken directly
+    if (not hResample and (src_left != 0 or src_right != 0)) or (not vResample and (src_top != 0 or src_bottom != 0)):
+        left, cWidth = (0, input.width) if hResample else (int(src_left), int(src_width))
+        top, cHeight = (0, input.height) if vResample else (int(src_top), int(src_height))
+        last = core.std.CropAbs(last, cWidth, cHeight, left, top)
+    
     if hResample:
-        last = core.std.Transpose(last)
-        last = nnedi3_resample_kernel_vertical(last, target_width, src_left, src_width, scale_thr, nsize, nns, qual, etype, pscrn, device, kernel, taps, a1, a2, invks, invkstaps, fast,flat_kernel,flat_a1,flat_a2,flat_taps)
-        last = core.std.Transpose(last)
+        last = nnedi3_resample_kernel_vertical(last, target_width, src_left, src_width, scale_thr, nsize, nns, qual, etype, pscrn, device, kernel, taps, a1, a2, invks, invkstaps, fast,flat_kernel,flat_a1,flat_a2,flat_taps, dw=True)
     if vResample:
         last = nnedi3_resample_kernel_vertical(last, target_height, src_top, src_height, scale_thr, nsize, nns, qual, etype, pscrn, device, kernel, taps, a1, a2, invks, invkstaps, fast,flat_kernel,flat_a1,flat_a2,flat_taps)
     
@@ -371,18 +587,21 @@ def nnedi3_resample_kernel(input, target_width=None, target_height=None, src_lef
     return last
 
 
-def nnedi3_resample_kernel_vertical(input, target_height=None, src_top=None, src_height=None, scale_thr=None, nsize=None, nns=None, qual=None, etype=None, pscrn=None, device=None, kernel=None, taps=None, a1=None, a2=None, invks=False, invkstaps=3, fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None):
+def nnedi3_resample_kernel_vertical(input, target_height=None, src_top=None, src_height=None, scale_thr=None, nsize=None, nns=None, qual=None, etype=None, pscrn=None, device=None, kernel=None, taps=None, a1=None, a2=None, invks=False, invkstaps=3, fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None, dw=False):
     core = vs.get_core()
     
+    # dw=True scales the width instead, using the native horizontal doubling of nnedi3cl
+    size = input.width if dw else input.height
+    
     # Parameters of scaling
     if target_height is None:
-        target_height = input.height
+        target_height = size
     if src_top is None:
         src_top = 0
     if src_height is None:
-        src_height = input.height
+        src_height = size
     elif src_height <= 0:
-        src_height = input.height - src_top + src_height
+        src_height = size - src_top + src_height
     if scale_thr is None:
         scale_thr = 1.125
     
@@ -406,25 +625,33 @@ def nnedi3_resample_kernel_vertical(input, target_height=None, src_top=None, src
         kernel = kernel.lower()
     
     # Skip scaling if not needed
-    if scale == 1 and src_top == 0 and src_height == input.height:
+    if scale == 1 and src_top == 0 and src_height == size:
         return input
     
     # Scaling with nnedi3
-    last = nnedi3_rpow2_vertical(input, eTimes, 1, nsize, nns, qual, etype, pscrn, device, fast,flat_kernel,flat_a1,flat_a2,flat_taps)
+    last = nnedi3_rpow2_vertical(input, eTimes, 1, nsize, nns, qual, etype, pscrn, device, fast,flat_kernel,flat_a1,flat_a2,flat_taps, dw)
     
     # Center shift calculation
     vShift = 0.5 if eTimes >= 1 else 0
     
     # Scaling with fmtc.resample as well as correct center shift
-    w = last.width
-    h = target_height
-    sx = 0
-    sy = src_top * eScale - vShift
-    sw = last.width
-    sh = src_height * eScale
-    
-    if h != last.height or sy != 0 or sh != last.height:
-        if h < last.height and invks is True:
+    if dw:
+        w = target_height
+        h = last.height
+        sx = src_top * eScale - vShift
+        sy = 0
+        sw = src_height * eScale
+        sh = last.height
+    else:
+        w = last.width
+        h = target_height
+        sx = 0
+        sy = src_top * eScale - vShift
+        sw = last.width
+        sh = src_height * eScale
+    
+    if w != last.width or h != last.height or sx != 0 or sy != 0 or sw != last.width or sh != last.height:
+        if (w < last.width or h < last.height) and invks is True:
             last = core.fmtc.resample(last, w, h, sx, sy, sw, sh, kernel=kernel, taps=taps, a1=a1, a2=a2, invks=True, invkstaps=invkstaps)
         else:
             last = core.fmtc.resample(last, w, h, sx, sy, sw, sh, kernel=kernel, taps=taps, a1=a1, a2=a2)
@@ -433,29 +660,30 @@ def nnedi3_resample_kernel_vertical(input, target_height=None, src_top=None, src
     return last
 
 
-def nnedi3_rpow2_vertical(input, eTimes=1, field=1, nsize=None, nns=None, qual=None, etype=None, pscrn=None, device=None, fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None):
+def nnedi3_rpow2_vertical(input, eTimes=1, field=1, nsize=None, nns=None, qual=None, etype=None, pscrn=None, device=None, fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None, dw=False):
     core = vs.get_core()
     
     if eTimes >= 1:
-        last = nnedi3_dh(input, field, nsize, nns, qual, etype, pscrn, device, fast,flat_kernel,flat_a1,flat_a2,flat_taps)
+        last = nnedi3_dh(input, field, nsize, nns, qual, etype, pscrn, device, fast,flat_kernel,flat_a1,flat_a2,flat_taps, dw)
         eTimes = eTimes - 1
         field = 0
     else:
         last = input
     
     if eTimes >= 1:
-        return nnedi3_rpow2_vertical(last, eTimes, field, nsize, nns, qual, etype, pscrn, device, fast,flat_kernel,flat_a1,flat_a2,flat_taps)
+        return nnedi3_rpow2_vertical(last, eTimes, field, nsize, nns, qual, etype, pscrn, device, fast,flat_kernel,flat_a1,flat_a2,flat_taps, dw)
     else:
         return last
 
 
-def nnedi3_dh(input, field=1, nsize=None, nns=None, qual=None, etype=None, pscrn=None,device=None, fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None):
+def nnedi3_dh(input, field=1, nsize=None, nns=None, qual=None, etype=None, pscrn=None,device=None, fast=None,flat_kernel=None,flat_a1=None,flat_a2=None,flat_taps=None, dw=False):
     core = vs.get_core()
     
     sFormat = input.format
     sSType = sFormat.sample_type
     sbitPS = sFormat.bits_per_sample
     sVSubS = 1 << sFormat.subsampling_h
+    sHSubS = 1 << sFormat.subsampling_w
     
     if fast is None:
         fast = False
@@ -468,14 +696,14 @@ def nnedi3_dh(input, field=1, nsize=None, nns=None, qual=None, etype=None, pscrn
         if flat_kernel=="nnedi3":
             flat_kernel="bicubic"
         input8 = mvf.Depth(input, depth=8, sample=vs.INTEGER)
-        nn = core.nnedi3cl.NNEDI3CL(input8, field=field, dh=True, nsize=nsize, nns=nns, qual=qual, etype=etype, pscrn=pscrn, device=device)
-        lr = core.fmtc.resample(input, sy=[-0.5, -0.5 * sVSubS] if field==0 else 0, scaleh=1, scalev=2, kernel=flat_kernel, a1=flat_a1, a2=flat_a2,taps=flat_taps,center=False)
+        nn = core.nnedi3cl.NNEDI3CL(input8, field=field, dh=not dw, dw=dw, nsize=nsize, nns=nns, qual=qual, etype=etype, pscrn=pscrn, device=device)
+        lr = core.fmtc.resample(input, sx=[-0.5, -0.5 * sHSubS] if field==0 else 0, scaleh=2, scalev=1, kernel=flat_kernel, a1=flat_a1, a2=flat_a2,taps=flat_taps,center=False) if dw else core.fmtc.resample(input, sy=[-0.5, -0.5 * sVSubS] if field==0 else 0, scaleh=1, scalev=2, kernel=flat_kernel, a1=flat_a1, a2=flat_a2,taps=flat_taps,center=False)
         return mvf.LimitFilter(mvf.Depth(lr, depth=sbitPS, sample=sSType), mvf.Depth(nn, depth=sbitPS, sample=sSType), thr=1.0, elast=2.0)
     elif flat_kernel=="nnedi3":
-        return core.nnedi3cl.NNEDI3CL(input, field=field, dh=True, nsize=nsize, nns=nns, qual=qual, etype=etype, pscrn=pscrn, device=device)
+        return core.nnedi3cl.NNEDI3CL(input, field=field, dh=not dw, dw=dw, nsize=nsize, nns=nns, qual=qual, etype=etype, pscrn=pscrn, device=device)
     else:
-        nn = core.nnedi3cl.NNEDI3CL(input, field=field, dh=True, nsize=nsize, nns=nns, qual=qual, etype=etype, pscrn=pscrn, device=device)
-        lr = core.fmtc.resample(input, sy=[-0.5, -0.5 * sVSubS] if field==0 else 0, scaleh=1, scalev=2, kernel=flat_kernel, a1=flat_a1, a2=flat_a2,taps=flat_taps,center=False)
+        nn = core.nnedi3cl.NNEDI3CL(input, field=field, dh=not dw, dw=dw, nsize=nsize, nns=nns, qual=qual, etype=etype, pscrn=pscrn, device=device)
+        lr = core.fmtc.resample(input, sx=[-0.5, -0.5 * sHSubS] if field==0 else 0, scaleh=2, scalev=1, kernel=flat_kernel, a1=flat_a1, a2=flat_a2,taps=flat_taps,center=False) if dw else core.fmtc.resample(input, sy=[-0.5, -0.5 * sVSubS] if field==0 else 0, scaleh=1, scalev=2, kernel=flat_kernel, a1=flat_a1, a2=flat_a2,taps=flat_taps,center=False)
         return mvf.LimitFilter(mvf.Depth(lr, depth=sbitPS, sample=sSType), mvf.Depth(nn, depth=sbitPS, sample=sSType), thr=1.0, elast=2.0)
         
 ## Gamma conversion functions from HAvsFunc-r18
@@ -496,63 +724,22 @@ def LinearToGamma(src, fulls=True, fulld=True, curve='709', planes=[0, 1, 2], gc
 def LinearAndGamma(src, l2g_flag, fulls, fulld, curve, planes, gcor, sigmoid, thr, cont):
     core = vs.get_core()
     
-    if curve == 'srgb':
-        c_num = 0
-    elif curve in ['709', '601', '170']:
-        c_num = 1
-    elif curve == '240':
-        c_num = 2
-    elif curve == '2020':
-        c_num = 3
-    else:
-        raise ValueError('LinearAndGamma: wrong curve value')
-    
     if src.format.color_family == vs.GRAY:
         planes = [0]
     
-    #                 BT-709/601
-    #        sRGB     SMPTE 170M   SMPTE 240M   BT-2020
-    k0    = [0.04045, 0.081,       0.0912,      0.08145][c_num]
-    phi   = [12.92,   4.5,         4.0,         4.5][c_num]
-    alpha = [0.055,   0.099,       0.1115,      0.0993][c_num]
-    gamma = [2.4,     2.22222,     2.22222,     2.22222][c_num]
-    
-    def g2l(x):
-        expr = x / 65536 if fulls else (x - 4096) / 56064
-        if expr <= k0:
-            expr /= phi
-        else:
-            expr = ((expr + alpha) / (1 + alpha)) ** gamma
-        if gcor != 1 and expr >= 0:
-            expr **= gcor
-        if sigmoid:
-            x0 = 1 / (1 + math.exp(cont * thr))
-            x1 = 1 / (1 + math.exp(cont * (thr - 1)))
-            expr = thr - math.log(max(1 / max(expr * (x1 - x0) + x0, 0.000001) - 1, 0.000001)) / cont
-        if fulld:
-            return min(max(round(expr * 65536), 0), 65535)
-        else:
-            return min(max(round(expr * 56064 + 4096), 0), 65535)
-    
-    # E' = (E <= k0 / phi)   ?   E * phi   :   (E ^ (1 / gamma)) * (alpha + 1) - alpha
-    def l2g(x):
-        expr = x / 65536 if fulls else (x - 4096) / 56064
-        if sigmoid:
-            x0 = 1 / (1 + math.exp(cont * thr))
-            x1 = 1 / (1 + math.exp(cont * (thr - 1)))
-            expr = (1 / (1 + math.exp(cont * (thr - expr))) - x0) / (x1 - x0)
-        if gcor != 1 and expr >= 0:
-            expr **= gcor
-        if expr <= k0 / phi:
-            expr *= phi
-        else:
-            expr = expr ** (1 / gamma) * (alpha + 1) - alpha
-        if fulld:
-            return min(max(round(expr * 65536), 0), 65535)
-        else:
-            return min(max(round(expr * 56064 + 4096), 0), 65535)
+    return core.std.Lut(src, planes=planes, lut=_transfer_lut(_gamma_steps(l2g_flag, curve, gcor, sigmoid, thr, cont), fulls, fulld))
+
+def _transfer(src, steps, fulls, fulld):
+    core = vs.get_core()
+    
+    planes = [0] if src.format.color_family == vs.GRAY else [0, 1, 2]
+    bits = src.format.bits_per_sample
+    
+    # Float clips are full range and get the curves as an expression
+    if src.format.sample_type == vs.FLOAT:
+        return core.std.Expr(src, [_transfer_expr(steps)])
     
-    return core.std.Lut(src, planes=planes, function=l2g if l2g_flag else g2l)
+    return core.std.Lut(src, planes=planes, lut=_transfer_lut(steps, fulls, fulld, bits), bits=16)
 
 # Apply the inverse sigmoid curve to a clip in linear luminance
 def SigmoidInverse(src, thr=0.5, cont=6.5, planes=[0, 1, 2]):
@@ -564,12 +751,7 @@ def SigmoidInverse(src, thr=0.5, cont=6.5, planes=[0, 1, 2]):
     if src.format.color_family == vs.GRAY:
         planes = [0]
     
-    def get_lut(x):
-        x0 = 1 / (1 + math.exp(cont * thr))
-        x1 = 1 / (1 + math.exp(cont * (thr - 1)))
-        return min(max(round((thr - math.log(max(1 / max(x / 65536 * (x1 - x0) + x0, 0.000001) - 1, 0.000001)) / cont) * 65536), 0), 65535)
-    
-    return core.std.Lut(src, planes=planes, function=get_lut)
+    return core.std.Lut(src, planes=planes, lut=_transfer_lut((('sinv', thr, cont),), True, True))
 
 # Convert back a clip to linear luminance
 def SigmoidDirect(src, thr=0.5, cont=6.5, planes=[0, 1, 2]):
@@ -581,10 +763,157 @@ def SigmoidDirect(src, thr=0.5, cont=6.5, planes=[0, 1, 2]):
     if src.format.color_family == vs.GRAY:
         planes = [0]
     
-    def get_lut(x):
-        x0 = 1 / (1 + math.exp(cont * thr))
-        x1 = 1 / (1 + math.exp(cont * (thr - 1)))
-        return min(max(round(((1 / (1 + math.exp(cont * (thr - x / 65536))) - x0) / (x1 - x0)) * 65536), 0), 65535)
-    
-    return core.std.Lut(src, planes=planes, function=get_lut)
+    return core.std.Lut(src, planes=planes, lut=_transfer_lut((('sdir', thr, cont),), True, True))
 ## Gamma conversion functions from HAvsFunc-r18
+
+
+# Transfer tables shared by the functions above
+# A curve is a tuple of steps applied in order to the normalized value:
+#     ('g2l', curve), ('l2g', curve), ('gcor', gcor), ('sinv', thr, cont), ('sdir', thr, cont)
+# Tables are built once per (steps, fulls, fulld, input bits) and kept for the whole process.
+# Inputs below 16-bit are scaled up first, by 65535 / (2 ** bits - 1) in full range and by shifting in limited range.
+# Set lut_cache_dir to a directory to also keep them on disk across runs.
+lut_cache_dir = None
+_lut_cache = {}
+
+#                     BT-709/601
+#            sRGB     SMPTE 170M   SMPTE 240M   BT-2020
+_curves = {'srgb': (0.04045, 12.92, 0.055, 2.4),
+           '709':  (0.081,   4.5,   0.099, 2.22222),
+           '601':  (0.081,   4.5,   0.099, 2.22222),
+           '170':  (0.081,   4.5,   0.099, 2.22222),
+           '240':  (0.0912,  4.0,   0.1115, 2.22222),
+           '2020': (0.08145, 4.5,   0.0993, 2.22222)}
+
+def _gamma_steps(l2g_flag, curve, gcor=1., sigmoid=False, thr=0.5, cont=6.5):
+    if curve not in _curves:
+        raise ValueError('LinearAndGamma: wrong curve value')
+    
+    gcor = () if gcor == 1 else (('gcor', gcor),)
+    sigmoid = (('sdir' if l2g_flag else 'sinv', thr, cont),) if sigmoid else ()
+    if l2g_flag:
+        return sigmoid + gcor + (('l2g', curve),)
+    else:
+        return (('g2l', curve),) + gcor + sigmoid
+
+def _transfer_lut(steps, fulls=True, fulld=True, bits=16):
+    key = (tuple(steps), bool(fulls), bool(fulld), bits)
+    lut = _lut_cache.get(key)
+    if lut is not None:
+        return lut
+    
+    path = None
+    if lut_cache_dir is not None:
+        import hashlib, os
+        path = os.path.join(lut_cache_dir, 'lut_' + hashlib.sha1(repr(key).encode()).hexdigest() + '.bin')
+        if os.path.isfile(path):
+            import array
+            table = array.array('H')
+            with open(path, 'rb') as f:
+                table.fromfile(f, 1 << bits)
+            lut = _lut_cache[key] = table.tolist()
+            return lut
+    
+    scale = 65535 / ((1 << bits) - 1) if fulls else 1 << (16 - bits)
+    try:
+        import numpy as np
+    except ImportError:
+        lut = [_transfer_scalar(x * scale, key[0], fulls, fulld) for x in range(1 << bits)]
+    else:
+        lut = _transfer_numpy(np, key[0], fulls, fulld, bits, scale).tolist()
+    
+    if path is not None:
+        import array, os
+        os.makedirs(lut_cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            array.array('H', lut).tofile(f)
+        os.replace(path + '.tmp', path)
+    
+    _lut_cache[key] = lut
+    return lut
+
+def _sigmoid_ends(thr, cont):
+    return 1 / (1 + math.exp(cont * thr)), 1 / (1 + math.exp(cont * (thr - 1)))
+
+def _transfer_scalar(x, steps, fulls, fulld):
+    expr = x / 65536 if fulls else (x - 4096) / 56064
+    for step in steps:
+        if step[0] == 'g2l':
+            k0, phi, alpha, gamma = _curves[step[1]]
+            if expr <= k0:
+                expr /= phi
+            else:
+                expr = ((expr + alpha) / (1 + alpha)) ** gamma
+        # E' = (E <= k0 / phi)   ?   E * phi   :   (E ^ (1 / gamma)) * (alpha + 1) - alpha
+        elif step[0] == 'l2g':
+            k0, phi, alpha, gamma = _curves[step[1]]
+            if expr <= k0 / phi:
+                expr *= phi
+            else:
+                expr = expr ** (1 / gamma) * (alpha + 1) - alpha
+        elif step[0] == 'gcor':
+            if expr >= 0:
+                expr **= step[1]
+        elif step[0] == 'sinv':
+            thr, cont = step[1:]
+            x0, x1 = _sigmoid_ends(thr, cont)
+            expr = thr - math.log(max(1 / max(expr * (x1 - x0) + x0, 0.000001) - 1, 0.000001)) / cont
+        elif step[0] == 'sdir':
+            thr, cont = step[1:]
+            x0, x1 = _sigmoid_ends(thr, cont)
+            expr = (1 / (1 + math.exp(cont * (thr - expr))) - x0) / (x1 - x0)
+    if fulld:
+        return min(max(round(expr * 65536), 0), 65535)
+    else:
+        return min(max(round(expr * 56064 + 4096), 0), 65535)
+
+def _transfer_numpy(np, steps, fulls, fulld, bits=16, scale=1):
+    x = np.arange(1 << bits, dtype=np.float64) * scale
+    expr = x / 65536 if fulls else (x - 4096) / 56064
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        for step in steps:
+            if step[0] == 'g2l':
+                k0, phi, alpha, gamma = _curves[step[1]]
+                expr = np.where(expr <= k0, expr / phi, ((expr + alpha) / (1 + alpha)) ** gamma)
+            elif step[0] == 'l2g':
+                k0, phi, alpha, gamma = _curves[step[1]]
+                expr = np.where(expr <= k0 / phi, expr * phi, expr ** (1 / gamma) * (alpha + 1) - alpha)
+            elif step[0] == 'gcor':
+                expr = np.where(expr >= 0, np.abs(expr) ** step[1], expr)
+            elif step[0] == 'sinv':
+                thr, cont = step[1:]
+                x0, x1 = _sigmoid_ends(thr, cont)
+                expr = thr - np.log(np.maximum(1 / np.maximum(expr * (x1 - x0) + x0, 0.000001) - 1, 0.000001)) / cont
+            elif step[0] == 'sdir':
+                thr, cont = step[1:]
+                x0, x1 = _sigmoid_ends(thr, cont)
+                expr = (1 / (1 + np.exp(cont * (thr - expr))) - x0) / (x1 - x0)
+    # np.rint rounds half to even like round() in the scalar path
+    if fulld:
+        expr = np.rint(expr * 65536)
+    else:
+        expr = np.rint(expr * 56064 + 4096)
+    return np.clip(expr, 0, 65535).astype(np.uint16)
+
+# The same steps as an std.Expr expression on full range float values
+def _transfer_expr(steps):
+    num = lambda x: repr(float(x))
+    expr = 'x'
+    for step in steps:
+        if step[0] == 'g2l':
+            k0, phi, alpha, gamma = _curves[step[1]]
+            expr = ' '.join([expr, num(k0), '<=', expr, num(phi), '/', expr, num(alpha), '+', num(1 + alpha), '/', num(gamma), 'pow', '?'])
+        elif step[0] == 'l2g':
+            k0, phi, alpha, gamma = _curves[step[1]]
+            expr = ' '.join([expr, num(k0 / phi), '<=', expr, num(phi), '*', expr, num(1 / gamma), 'pow', num(alpha + 1), '*', num(alpha), '-', '?'])
+        elif step[0] == 'gcor':
+            expr = ' '.join([expr, '0', '>=', expr, num(step[1]), 'pow', expr, '?'])
+        elif step[0] == 'sinv':
+            thr, cont = step[1:]
+            x0, x1 = _sigmoid_ends(thr, cont)
+            expr = ' '.join([num(thr), '1', expr, num(x1 - x0), '*', num(x0), '+', '0.000001', 'max', '/', '1', '-', '0.000001', 'max', 'log', num(cont), '/', '-'])
+        elif step[0] == 'sdir':
+            thr, cont = step[1:]
+            x0, x1 = _sigmoid_ends(thr, cont)
+            expr = ' '.join(['1', '1', num(thr), expr, '-', num(cont), '*', 'exp', '+', '/', num(x0), '-', num(x1 - x0), '/'])
+    return expr
@@ -13,7 +13,22 @@ HolyWu for original Overlay/InterFrame function.
 Dave <orangechannel@pm.me> for refactoring code.
 """
 
-import re
+import array
+import atexit
+import bisect
+import json
+import math
+import mmap
+import os
+import queue
+import random
+import struct
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+from fractions import Fraction
 from functools import partial
 from typing import Dict
 
@@ -318,7 +333,8 @@ def stpresso_mc(clip: vs.VideoNode, limit=3, bias=24, rg_mode=4, tthr=12,
 
 
 def splicev1(clip: List[vs.VideoNode], num: List[int] = None,
-             den: List[int] = None, tc_out: str = "tc v1.txt"):
+             den: List[int] = None, tc_out: str = "tc v1.txt",
+             tc_out_v2: str = None):
     """Splices clips with different fps and output timecodes v1.
 
     :param clip: input clips
@@ -330,6 +346,8 @@ def splicev1(clip: List[vs.VideoNode], num: List[int] = None,
     :param num: clips' fps numerators
     :param den: clips' fps denominators
     :param tc_out: outfile.txt
+    :param tc_out_v2: optional timecodes v2 outfile, timestamps are exact
+                      fractions of each clip's fps (Default value = None)
     :return: TODO
     """
     num = [] if not num else num
@@ -357,24 +375,37 @@ def splicev1(clip: List[vs.VideoNode], num: List[int] = None,
             else:
                 den[i] = 1
 
-    fps = []
-    for i in range(clip_len):
-        fps.append(float(num[i]) / den[i])
+    fps = [Fraction(num[i], den[i]) for i in range(clip_len)]
 
     fnum = [i.num_frames for i in clip]
     for i in range(1, clip_len):
         fnum[i] += fnum[i - 1]
 
-    tc = open(tc_out, 'w')
-    tc.write('# timecode format v1\nassume ' + str(fps[0]) + '\n')
-    for i in range(1, clip_len):
-        tc.write(str(fnum[i - 1]) + ',' + str(fnum[i] - 1) + ',' +
-                 str(fps[i]) + '\n')
-    tc.close()
-
-    last = clip[0]
+    # Adjacent segments sharing an fps collapse into one v1 range and
+    # segments at the assumed fps need none.
+    ranges = []
     for i in range(1, clip_len):
-        last += clip[i]
+        first, end = fnum[i - 1], fnum[i] - 1
+        if end < first or fps[i] == fps[0]:
+            continue
+        if ranges and ranges[-1][2] == fps[i] and ranges[-1][1] + 1 == first:
+            ranges[-1][1] = end
+        else:
+            ranges.append([first, end, fps[i]])
+    writetcv1(tc_out, fps[0], ranges)
+
+    if tc_out_v2 is not None:
+        def timestamps():
+            t = Fraction(0)
+            for i in range(clip_len):
+                step = 1000 / fps[i]
+                for _ in range(clip[i].num_frames):
+                    yield t
+                    t += step
+            yield t
+        writetcv2(tc_out_v2, timestamps())
+
+    last = core.std.Splice(clip)
 
     return core.std.AssumeFPS(last, fpsnum=num[0], fpsden=den[0])
 
@@ -884,66 +915,139 @@ def SAdeband(src,thr=128,f3kdb_arg={},smoothmask=0,Sdbclip=None,Smask=None,tvran
     merge = core.std.MaskedMerge(clip, db, mask, planes=0)
     return core.std.ShufflePlanes([merge,db],[0,1,2], colorfamily=vs.YUV)
 
-def vfrtocfr(clip=None,tc=None,num=None,den=1,blend=False):
+def vfrtocfr(clip=None,tc=None,num=None,den=1,blend=False,cache=None,source=None):
     """
     vfrtocfr
     --------------------------------
     clip: input clip
-    tc: input timecodes,only support tcv2
+    tc: input timecodes,tcv1 or tcv2
+        if None,timestamps are built from the _DurationNum/_DurationDen props of clip,
+        pass the source clip then,every frame is requested once to read its props
     num,den: output fps=num/den
     blend: True means blend the frames instead of delete or copy , default is False
+           blend weights are quantized to 1/16 steps,set an int instead of True to use another number of steps
+    cache: file to save/load the timestamps read from props,only used when tc is None
+    source: path of the source file,identifies the cache,see proptc
     """
-    def tclist(f):
-        A=open(f,"r")
-        B=re.sub(r'(.\n)*# timecode format v2(.|\n)*\n0',r'0',A.read(),count=1)
-        A.close()
-        C=B.split()
-        T=[]
-        for i in C:
-            T.append(int(float(i)))
-        return T
-    #################
     vn = clip.num_frames
-    vtc = tclist(tc)
+    vtc = readtc(tc,vn) if tc is not None else proptc(clip,cache,source=source)
+    base = vtc.base
     cn = int(vtc[-1]*num/den/1000)
-    ctc = [int(1000*den/num)*i for i in range(0,cn+1)]
-    cc = clip[0]
-    for i in range(1,cn+1):
-        for j in range(1,vn+1):
-            if ctc[i]<vtc[1]:
-                cc += clip[0]
-            elif ctc[i]>=vtc[j] and ctc[i]<vtc[j+1]:
-                if blend == False:
-                    cl=clip[j-1] if (ctc[i]-vtc[j])>(vtc[j+1]-ctc[i]) else clip[j]
-                else:
-                    cl=core.std.Merge(clip[j-1],clip[j],weight=(ctc[i]-vtc[j])/(vtc[j+1]-vtc[j]))
-                cc += cl
+    #map every output timestamp to the source frame shown at that time
+    #(and its successor), vtc is sorted so bisect is enough
+    fmap = []
+    weights = []
+    for i in range(cn+1):
+        #t = 1000*den*i/num ms, compared in 1/base ms units
+        t = Fraction(1000*den*i*base,num)
+        j = min(max(bisect.bisect_right(vtc.data,math.floor(t))-1,0),vn-1)
+        k = min(j+1,vn-1)
+        w = float((t-vtc.data[j])/(vtc.data[k]-vtc.data[j])) if k != j and t > vtc.data[j] else 0
+        if blend == False:
+            fmap.append(k if w > 0.5 else j)
+        else:
+            fmap.append(j)
+            weights.append(w)
+    if blend == False:
+        cc = core.std.SelectEvery(clip, vn, fmap)
+    else:
+        #one shared Merge per quantized weight,picked per output frame by a single SelectEvery
+        steps = 16 if blend is True else int(blend)
+        nxt = clip[1:]+clip[-1] if vn > 1 else clip
+        table = [clip]+[core.std.Merge(clip,nxt,weight=b/steps) for b in range(1,steps)]+[nxt]
+        cc = core.std.SelectEvery(core.std.Interleave(table), vn*(steps+1), [j*(steps+1)+round(w*steps) for j,w in zip(fmap,weights)])
     last = core.std.AssumeFPS(cc,fpsnum=num,fpsden=den)
     return core.std.Cache(last, make_linear=True)
 
 def getPictType(clip,txt=None,show=True):
     """
     getPictType
+    --------------------------------
+    txt: write "n,type" lines to this file,default:None
+    show: draw "PictType:I/P/B" on the frames,False only logs,default:True
+    use keyframes to build a reusable index of I frames without rendering
     """
-    sclip=core.std.PlaneStats(clip, plane=0)
     log = txt is not None
+    if not log and not show:
+        return clip
     if log:
-        t = open(txt,'w')
+        t = _OrderedWriter(txt,"",clip.num_frames)
+    #labelled clips are built once and picked per frame
+    labelled = {}
+    def label(ptype):
+        if ptype not in labelled:
+            labelled[ptype] = core.text.Text(clip, "PictType:"+ptype)
+        return labelled[ptype]
+    if show:
+        for ptype in "IPB":
+            label(ptype)
     def __type(n, f, clip, core):
-        ptype = str(f.props._PictType)[2]
+        ptype = _picttype(f)
         if log:
-            t.write(str(n)+","+ptype)
-            t.write('\n')
+            t.write(n,str(n)+","+ptype+"\n")
         if show:
-            return core.text.Text(clip, "PictType:"+ptype)
+            return label(ptype)
         else:
             return clip
-        if log:
-            t.close()
-    last = core.std.FrameEval(clip, functools.partial(__type, clip=clip,core=core),prop_src=sclip)
+    last = core.std.FrameEval(clip, functools.partial(__type, clip=clip,core=core),prop_src=clip)
     return last
 
-def FIFP(src,mode=0,tff=True,mi=40,blockx=16,blocky=16,cthresh=8,chroma=False,metric=1,tc=True,_pass=1,opencl=False,device=-1):
+def _picttype(f):
+    ptype = f.props['_PictType']
+    return (ptype.decode() if isinstance(ptype, bytes) else str(ptype))[:1]
+
+def keyframes(clip,source=None,cache=None,window=None,progress=True):
+    """
+    keyframes
+    --------------------------------
+    index of the I frames of clip,for picking chunk/segment boundaries and seek points
+    frames are requested in process for their _PictType,the index is saved to a sidecar file and reused
+    clip: source clip
+    source: path of the source file,its size and mtime identify the sidecar,default cache is source+".kfi"
+    cache: sidecar path,False means don't cache,default:None
+    window,progress: same as getprops
+    return: array('I') of I frame numbers,sorted
+    """
+    if cache is None and source is not None:
+        cache = source+".kfi"
+    st = os.stat(source) if source is not None else None
+    key = (st.st_size, st.st_mtime_ns, clip.num_frames) if st else (0, 0, clip.num_frames)
+    if cache and os.path.isfile(cache):
+        with open(cache,"rb") as f:
+            if f.read(6) == b"XVSKF1" and struct.unpack("<qqq",f.read(24)) == key:
+                count, = struct.unpack("<q",f.read(8))
+                kf = array.array('I')
+                kf.fromfile(f,count)
+                return kf
+    kf = array.array('I')
+    for n,f in _progress(_prefetch(clip,window=window),clip.num_frames,progress):
+        if _picttype(f) == "I":
+            kf.append(n)
+    if cache:
+        with open(cache,"wb") as f:
+            f.write(b"XVSKF1"+struct.pack("<qqqq",*key,len(kf)))
+            kf.tofile(f)
+    return kf
+
+def gopstart(kf,n):
+    """
+    the I frame to start decoding from to reach frame n
+    """
+    i = bisect.bisect_right(kf,n)-1
+    return kf[i] if i >= 0 else 0
+
+def gopchunks(kf,num_frames,length):
+    """
+    split [0,num_frames) into (first,last+1) chunks of about length frames,every chunk starts at an I frame
+    """
+    bounds = [0]
+    for k in kf:
+        if k-bounds[-1] >= length:
+            bounds.append(k)
+    bounds.append(num_frames)
+    return list(zip(bounds[:-1],bounds[1:]))
+
+def FIFP(src,mode=0,tff=True,mi=40,blockx=16,blocky=16,cthresh=8,chroma=False,metric=1,tc=True,_pass=1,opencl=False,device=-1,analysis=None,lookahead=None,block=False):
     """
     Fix Interlanced Frames in Progressive video
     ---------------------------------------
@@ -961,24 +1065,40 @@ def FIFP(src,mode=0,tff=True,mi=40,blockx=16,blocky=16,cthresh=8,chroma=False,me
     mode args:
     mode = 0:
            interlaced frames will be deinterlaced in the same fps
+       analysis:path of an analyze.csv or a list of 0/1 per frame,default:None
+                if set,combed frames are taken from it and picked by one SelectEvery,no python runs per frame
+       block:if True,combed frames are deinterlaced in strips of 4 blocks high,with the same IsCombed settings
+             only the combed strips are deinterlaced,the rest of the frame is copied from src,default:False
     mode = 1:
            interlaced frames will be deinterlaced in double fps,and output timecodes to create a vfr video
            need 2 pass
        _pass:
+           0:convenience wrapper,runs FIFPanalyze(src,file=None) while building the clip,then does pass 2 with its flags,
+             it is not a one pass mode:the analysis decodes the whole source before the clip is returned
+             and the encode decodes it again,same as pass 1 + pass 2
            1:analyze pass
            2:encode pass,can output timecodes
+       lookahead:window of FIFPanalyze when _pass=0,default:2*core.num_threads
        tc:if True，will output timecodes,suggest set True only when finally encode,default:True
     ---------------------------------------
     notice:
        analyze.csv will be created when mode=1,_pass=1,you can check and revise it，then use in pass 2
+       FIFPanalyze creates the same file in process,with script set it analyzes ranges of the clip in parallel processes
+       pass 2 and mode=0 also accept another file or a list of 0/1 through analysis
     """
-    clip = src if src.format.bits_per_sample==8 else core.fmtc.bitdepth(src,bits=8,dmode=8)
     order = 1 if tff else 0
     
-    dect = core.tdm.IsCombed(clip,cthresh=cthresh,blockx=blockx,blocky=blocky,chroma=chroma,mi=mi,metric=metric)
+    dect = _fifpdetect(src,mi,blockx,blocky,cthresh,chroma,metric)
 
     if mode==0:
         deinterlace = core.nnedi3cl.NNEDI3CL(src, field=order,device=device) if opencl else core.znedi3.nnedi3(src, field=order)
+        if analysis is not None:
+            lst=_readcombed(analysis,src.num_frames)
+            #frame 2i is src[i],2i+1 is deinterlace[i]
+            mix=core.std.Interleave([src,deinterlace])
+            return core.std.SelectEvery(mix,len(lst)*2,[2*i+(1 if v else 0) for i,v in enumerate(lst)])
+        if block:
+            return _fifpblock(src,dect,order,blockx,blocky,cthresh,mi,chroma,metric,opencl,device)
         ###
         def postprocess(n, f, clip, de):
             if f.props['_Combed'] == 1:
@@ -991,66 +1111,194 @@ def FIFP(src,mode=0,tff=True,mi=40,blockx=16,blocky=16,cthresh=8,chroma=False,me
         return last
     elif mode==1:
         if _pass==1:
-            t = open("analyze.csv",'w')
-            t.write("frame,combed\n")
+            t = _OrderedWriter("analyze.csv","frame,combed\n",dect.num_frames)
             def analyze(n, f, clip):
-                t.write(str(n)+","+str(f.props['_Combed'])+"\n")
+                t.write(n,str(n)+","+str(f.props['_Combed'])+"\n")
                 return clip
-                t.close()
             last=core.std.FrameEval(dect, functools.partial(analyze, clip=dect),prop_src=dect)
             last=core.std.Cache(last, make_linear=True)
             return last
-        elif _pass==2:
-            lenlst=len(src)
+        elif _pass==0 or _pass==2:
             num=src.fps_num
             den=src.fps_den
-            c=open("analyze.csv","r")
-            tmp=c.read().split("\n")[1:lenlst]
-            lst=[None]*len(tmp)
-            for i in tmp:
-                i=i.split(",")
-                lst[int(i[0])]=int(i[1])
-            c.close()
-            lenlst=len(lst)
+            b=Fraction(1000*den,num)
+            def timestamps(flags):
+                yield 0
+                for i,v in flags:
+                    if v==0:
+                        yield (i+1)*b
+                    elif v==1:
+                        yield (i+Fraction(1,2))*b
+                        yield (i+1)*b
+                    else:
+                        raise ValueError("")
             
+            if _pass==0:
+                lst=FIFPanalyze(src,file=None,window=lookahead,mi=mi,blockx=blockx,blocky=blocky,cthresh=cthresh,chroma=chroma,metric=metric)
+            else:
+                lst=_readcombed("analyze.csv" if analysis is None else analysis,len(src))
             #tc
             if tc:
-                c=open("timecodes.txt","w")
-                c.write("# timecode format v2\n0\n")
-                b=1000/num*den
-                for i in range(lenlst):
-                    if lst[i]==0:
-                        c.write(str(int((i+1)*b))+"\n")
-                    elif lst[i]==1:
-                        c.write(str(int((i+0.5)*b))+"\n"+str(int((i+1)*b))+"\n")
-                    else:
-                        raise ValueError("")
-                c.close()
+                writetcv2("timecodes.txt",timestamps(enumerate(lst)))
+            lenlst=len(lst)
             
             #deinterlace
             deinterlace = core.nnedi3cl.NNEDI3CL(src, field=order+2,device=device) if opencl else core.znedi3.nnedi3(src, field=order+2)
-            src= core.std.Interleave([src,src])
-            def postprocess(n,clip, de):
-                if lst[n//2]==0:
-                    return clip
-                else:
-                    return de
-            dl=core.std.FrameEval(src, functools.partial(postprocess, clip=src, de=deinterlace))
-            di=core.std.Cache(di, make_linear=True)
+            #frame 4i is src[i],4i+1 and 4i+3 are the two deinterlaced fields of frame i
+            mix= core.std.Interleave([core.std.Interleave([src,src]),deinterlace])
             tlist=[]
             for i in range(lenlst):
                 if lst[i]==0:
-                    tlist.append(2*i)
+                    tlist.append(4*i)
                 else:
-                    tlist.append(2*i)
-                    tlist.append(2*i+1)
-            last = core.std.SelectEvery(dl,lenlst*2,tlist)
+                    tlist.append(4*i+1)
+                    tlist.append(4*i+3)
+            last = core.std.SelectEvery(mix,lenlst*4,tlist)
             return last#core.std.AssumeFPS(last,src)
         else:
-            ValueError("pass must be 1 or 2")
+            raise ValueError("pass must be 0,1 or 2")
     else:
         raise ValueError("mode must be 0 or 1")
 
+def FIFPanalyze(src,file="analyze.csv",window=None,mi=40,blockx=16,blocky=16,cthresh=8,chroma=False,metric=1,script=None,processes=None):
+    """
+    FIFP analyze pass without rendering through vspipe
+    ---------------------------------------
+    without script,frames are requested in order with a window of requests in flight,the source is decoded linearly
+    with script,the clip is split into processes ranges of consecutive frames,every range is analyzed by its own
+    worker process which runs the script again to build its own source and decodes its range linearly,
+    every worker writes its flags to its own csv and the chunks are merged in frame order,so the result never
+    depends on scheduling
+    ---------------------------------------
+    file: output analyze.csv,a name ending with .xfs writes a FrameStore,None means don't write,default:"analyze.csv"
+    window: requests in flight per process,default:2*core.num_threads
+    script: path of a .vpy script whose output 0 is src,run with __name__ == "__vapoursynth__" in every worker,default:None
+    processes: number of worker processes when script is set,default:os.cpu_count(),the core threads are shared between them
+    other args are the same as FIFP
+    return: combed flag of every frame,can be passed to FIFP as analysis
+    """
+    n = src.num_frames
+    args = (mi,blockx,blocky,cthresh,chroma,metric)
+    if script is None:
+        dect = core.std.Cache(_fifpdetect(src,*args), make_linear=True)
+        lst = bytearray(n)
+        for k,f in _prefetch(dect,window=window):
+            lst[k] = f.props['_Combed']
+    else:
+        import multiprocessing,tempfile
+        from concurrent.futures import ProcessPoolExecutor
+        processes = max(min(processes if processes else os.cpu_count() or 1,n),1)
+        threads = max((os.cpu_count() or 1)//processes,1)
+        bounds = [n*i//processes for i in range(processes+1)]
+        tmp = tempfile.mkdtemp(prefix="fifp",dir=os.path.dirname(os.path.abspath(file)) if file else None)
+        parts = [os.path.join(tmp,"{}.csv".format(i)) for i in range(processes)]
+        try:
+            with ProcessPoolExecutor(processes,mp_context=multiprocessing.get_context("spawn")) as pool:
+                jobs = [pool.submit(_fifpchunk,script,n,bounds[i],bounds[i+1],parts[i],args,window,threads) for i in range(processes)]
+                for job in jobs:
+                    job.result()
+            lst = bytearray(n)
+            for part in parts:
+                with open(part,"r") as c:
+                    c.readline()
+                    for line in c:
+                        k,v = line.split(",")
+                        lst[int(k)] = int(v)
+        finally:
+            for part in parts:
+                if os.path.isfile(part):
+                    os.remove(part)
+            os.rmdir(tmp)
+    if file is not None and file.lower().endswith(".xfs"):
+        t = FrameStore.create(file,["combed"],"B",n)
+        t["combed"][:] = lst
+        t.valid[:] = b"\x01"*n
+        t.close()
+    elif file is not None:
+        with open(file,"w") as t:
+            t.write("frame,combed\n")
+            t.writelines("{},{}\n".format(i,v) for i,v in enumerate(lst))
+    return lst
+
+def _fifpchunk(script,num_frames,start,end,file,args,window,threads):
+    """
+    FIFPanalyze worker:build the source from script and write the flags of [start,end) to file
+    """
+    import runpy
+    core.num_threads = threads
+    runpy.run_path(script,run_name="__vapoursynth__")
+    out = vs.get_output(0)
+    src = getattr(out,"clip",out)
+    if src.num_frames != num_frames:
+        raise ValueError("FIFPanalyze: {} outputs {} frames,src has {}".format(script,src.num_frames,num_frames))
+    dect = core.std.Cache(_fifpdetect(src,*args), make_linear=True)
+    with open(file,"w") as t:
+        t.write("frame,combed\n")
+        t.writelines("{},{}\n".format(k,f.props['_Combed']) for k,f in _prefetch(dect,start,end,window))
+
+def _fifpdetect(src,mi,blockx,blocky,cthresh,chroma,metric):
+    clip = src if src.format.bits_per_sample==8 else core.fmtc.bitdepth(src,bits=8,dmode=8)
+    return core.tdm.IsCombed(clip,cthresh=cthresh,blockx=blockx,blocky=blocky,chroma=chroma,mi=mi,metric=metric)
+
+def _fifpblock(src,dect,order,blockx,blocky,cthresh,mi,chroma,metric,opencl,device,grid=4):
+    """
+    deinterlace the horizontal strips of each combed frame that IsCombed flags,the rest is copied from src
+    strips are grid blocks high,all of them go through one deinterlacer and one IsCombed as frames of an interleaved clip,
+    so the graph is built once and only picked per frame
+    """
+    w,h = src.width,src.height
+    ay = 2 << src.format.subsampling_h
+    hs = -(-grid*blocky//ay)*ay
+    if hs >= h or h % ay:
+        hs = h
+    k = -(-h//hs)
+    #the last strip is moved up to keep every strip the same size,only its lower rows are used
+    tops = [min(i*hs,h-hs) for i in range(k)]
+    strips = core.std.Interleave([core.std.CropAbs(src,w,hs,0,t) for t in tops]) if k > 1 else src
+    deint = core.nnedi3cl.NNEDI3CL(strips, field=order,device=device) if opencl else core.znedi3.nnedi3(strips, field=order)
+    combed = _fifpdetect(strips,mi,blockx,blocky,cthresh,chroma,metric)
+    flags = [core.std.SelectEvery(combed,k,i) for i in range(k)]
+    #a frame IsCombed flags as a whole is deinterlaced completely if no strip is flagged on its own
+    def pick(n,f,i,srow,drow):
+        if f[0].props['_Combed'] != 1:
+            return srow
+        fl = [x.props['_Combed'] for x in f[1:]]
+        return drow if fl[i] == 1 or 1 not in fl else srow
+    rows = []
+    for i,t in enumerate(tops):
+        r = min(hs,h-i*hs)
+        srow = core.std.CropAbs(src,w,r,0,i*hs)
+        drow = core.std.SelectEvery(deint,k,i)
+        if r != hs or t != i*hs:
+            drow = core.std.CropAbs(drow,w,r,0,i*hs-t)
+        rows.append(core.std.FrameEval(srow,partial(pick,i=i,srow=srow,drow=drow),prop_src=[dect]+flags))
+    return core.std.StackVertical(rows) if k > 1 else rows[0]
+
+def _readcombed(analysis,num_frames):
+    """
+    combed flag of every frame from an analyze.csv/.xfs path or a list of 0/1
+    """
+    if not isinstance(analysis,str):
+        if len(analysis) != num_frames:
+            raise ValueError("FIFP: analysis has {} frames,clip has {}".format(len(analysis),num_frames))
+        return bytearray(analysis)
+    lst=bytearray(num_frames)
+    if analysis.lower().endswith(".xfs"):
+        c=FrameStore(analysis)
+        data=bytes(c["combed"][:num_frames])
+        c.close()
+        lst[:len(data)]=data
+        return lst
+    with open(analysis,"r") as c:
+        c.readline()
+        for line in c:
+            line=line.strip()
+            if line:
+                n,v=line.split(",")[:2]
+                if int(n) < num_frames:
+                    lst[int(n)]=int(v)
+    return lst
+
 def Overlaymod(clipa, clipb, x=0, y=0, alpha=None,aa=False):
     """
     Overlaymod
@@ -1379,45 +1627,19 @@ def xTonemap(clip,nominal_luminance=400,exposure=4.5):
 def statsinfo2csv(clip,plane=None,Max=True,Min=True,Avg=False,bits=8,namebase=None):
     """
     write PlaneStats(Max,Min,Avg) to csv
+    all planes are collected in one pass,one csv per plane
+    namebase ending with .xfs writes all planes to one FrameStore instead,columns are named like "Y.Max"
     """
 
     cbits=clip.format.bits_per_sample
     cfamily=clip.format.color_family
-    #########
-    def info(clip,t,p):
-        statsclip=core.std.PlaneStats(clip, plane=p)
-        txt = open(t,'w')
-        #############
-        head="n"
-        head+=",Max" if Max else ""
-        head+=",Min" if Min else ""
-        head+=",Avg" if Avg else ""
-        head+="\n"
-        txt.write(head)
-        #############
-        def write(n, f, clip, core,Max,Min,Avg,bits):
-            ma = int(round(f.props.PlaneStatsMax*(1<<bits)/(1<<cbits)))
-            mi = int(round(f.props.PlaneStatsMin*(1<<bits)/(1<<cbits)))
-            avg=int(round(f.props.PlaneStatsAverage*(1<<bits)))
-            ######
-            line=str(n)
-            line+=(","+str(ma)) if Max else ""
-            line+=(","+str(mi)) if Min else ""
-            line+=(","+str(avg)) if Avg else ""
-            line+="\n"
-            txt.write(line)
-            ######
-            return clip
-            txt.close()
-        last = core.std.FrameEval(clip,functools.partial(write, clip=clip,core=core,Max=Max,Min=Min,Avg=Avg,bits=bits),prop_src=statsclip)
-        return last
     ###############
     if cfamily == vs.YUV:
         pname=('Y','U','V')
     elif cfamily == vs.RGB:
         pname=('R','G','B')
     elif cfamily == vs.GRAY:
-        pname=('GRAY')
+        pname=('GRAY',)
     else:
         raise ValueError("")
     ###############
@@ -1428,13 +1650,30 @@ def statsinfo2csv(clip,plane=None,Max=True,Min=True,Avg=False,bits=8,namebase=No
             plane=[0,1,2]
     elif isinstance(plane,int):
         plane=[plane]
-    elif not isinstance(plane,list,tuple):
+    elif not isinstance(plane,(list,tuple)):
         raise TypeError()
     ###############
+    statsclip=clip
     for i in plane:
-        name= pname[i]+".csv" if namebase is None else namebase+'.'+pname[i]+".csv"
-        clip = info(clip,name,i)
-    return clip
+        statsclip=core.std.PlaneStats(statsclip, plane=i, prop="PlaneStats"+pname[i])
+    head=[k for k,v in (("Max",Max),("Min",Min),("Avg",Avg)) if v]
+    if namebase is not None and namebase.lower().endswith(".xfs"):
+        names=[pname[i]+"."+k for i in plane for k in head]
+        sinks=[(_framesink(namebase,["n"]+names,"i"*len(names),clip.num_frames),plane)]
+    else:
+        sinks=[(_framesink(pname[i]+".csv" if namebase is None else namebase+'.'+pname[i]+".csv",["n"]+head,"iii",clip.num_frames),[i]) for i in plane]
+    #############
+    def write(n, f, clip):
+        values={}
+        for i in plane:
+            p="PlaneStats"+pname[i]
+            values[i]=[int(round(f.props[p+"Max"]*(1<<bits)/(1<<cbits)))] if Max else []
+            values[i]+=[int(round(f.props[p+"Min"]*(1<<bits)/(1<<cbits)))] if Min else []
+            values[i]+=[int(round(f.props[p+"Average"]*(1<<bits)))] if Avg else []
+        for sink,ps in sinks:
+            sink.put(n,[v for i in ps for v in values[i]])
+        return clip
+    return core.std.FrameEval(clip,functools.partial(write, clip=clip),prop_src=statsclip)
 
 def XSAA(src,nsize=None,nns=2,qual=None,aamode=-1,maskmode=1,opencl=False,device=-1,linedarken=False,preaa=0):
     """
@@ -1582,7 +1821,9 @@ def ssim2csv(clip1,clip2,file="ssim.csv",planes=None, downsample=True, k1=0.01,
 
         clip2: Reference clip, must be of the same format and dimension as the "clip1".
 
-        file:  output file name
+        file:  output file name,a name ending with .xfs writes a FrameStore instead of csv
+               None means write nothing and attach the scores to the output as props(PlaneSSIM for GRAY,PlaneSSIMY,PlaneSSIMU... otherwise),
+               to be collected with getprops
 
         plane: (int/list) Specify which planes to be processed. Default is None.
 
@@ -1612,55 +1853,33 @@ def ssim2csv(clip1,clip2,file="ssim.csv",planes=None, downsample=True, k1=0.01,
         planes=[planes]
     if isGRAY:
         clip=muf.SSIM(clip1, clip2, plane=0, downsample=downsample, k1=k1, k2=k2, fun=fun, dynamic_range=dynamic_range, show_map=False, **depth_args)
-        txt = open(file,'w')
-        txt.write("n,gary\n")
+        txt = _framesink(file,["n","gary"],"d",clip.num_frames) if file is not None else None
         def tocsv(n, f, clip ,core):
-            txt.write(str(n)+","+str(f.props.PlaneSSIM)+"\n")
+            txt.put(n,[f.props.PlaneSSIM])
             return clip
-            txt.close()
-        last=core.std.FrameEval(clip,functools.partial(tocsv, clip=clip,core=core),prop_src=clip)
+        last=core.std.FrameEval(clip,functools.partial(tocsv, clip=clip,core=core),prop_src=clip) if file is not None else clip
     elif isYUV:
         if planes is None:
             planes=[0,1,2]
         Y=muf.SSIM(getY(clip1),getY(clip2),plane=0, downsample=downsample, k1=k1, k2=k2, fun=fun, dynamic_range=dynamic_range, show_map=False, **depth_args) if 0 in planes else getY(clip1)
         U=muf.SSIM(getU(clip1),getU(clip2),plane=0, downsample=downsample, k1=k1, k2=k2, fun=fun, dynamic_range=dynamic_range, show_map=False, **depth_args) if 1 in planes else getU(clip1)
         V=muf.SSIM(getV(clip1),getV(clip2),plane=0, downsample=downsample, k1=k1, k2=k2, fun=fun, dynamic_range=dynamic_range, show_map=False, **depth_args) if 2 in planes else getV(clip1)
-        txt = open(file,'w')
-        head="n"
-        head+=",Y" if 0 in planes else ""
-        head+=",U" if 1 in planes else ""
-        head+=",V" if 2 in planes else ""
-        txt.write(head+"\n")
+        txt = _framesink(file,["n"]+[p for i,p in enumerate("YUV") if i in planes],"ddd",clip1.num_frames) if file is not None else None
         def tocsv(n,f,clip,core):
-            line=str(n)
-            line+=(","+str(f[0].props.PlaneSSIM)) if 0 in planes else ""
-            line+=(","+str(f[1].props.PlaneSSIM)) if 1 in planes else ""
-            line+=(","+str(f[2].props.PlaneSSIM)) if 2 in planes else ""
-            txt.write(line+"\n")
+            txt.put(n,[f[i].props.PlaneSSIM for i in range(3) if i in planes])
             return clip
-            txt.close()
-        last=core.std.FrameEval(clip1,functools.partial(tocsv, clip=clip1,core=core),prop_src=[Y,U,V])
+        last=core.std.FrameEval(clip1,functools.partial(tocsv, clip=clip1,core=core),prop_src=[Y,U,V]) if file is not None else _copyprops(clip1,[Y,U,V],"PlaneSSIM",planes,"YUV")
     elif isRGB:
         if planes is None:
             planes=[0,1,2]
         R=muf.SSIM(getY(clip1),getY(clip2),plane=0, downsample=downsample, k1=k1, k2=k2, fun=fun, dynamic_range=dynamic_range, show_map=False, **depth_args) if 0 in planes else getY(clip1)
         G=muf.SSIM(getU(clip1),getU(clip2),plane=0, downsample=downsample, k1=k1, k2=k2, fun=fun, dynamic_range=dynamic_range, show_map=False, **depth_args) if 1 in planes else getU(clip1)
         B=muf.SSIM(getV(clip1),getV(clip2),plane=0, downsample=downsample, k1=k1, k2=k2, fun=fun, dynamic_range=dynamic_range, show_map=False, **depth_args) if 2 in planes else getV(clip1)
-        txt = open(file,'w')
-        head="n"
-        head+=",R" if 0 in planes else ""
-        head+=",G" if 1 in planes else ""
-        head+=",B" if 2 in planes else ""
-        txt.write(head+"\n")
+        txt = _framesink(file,["n"]+[p for i,p in enumerate("RGB") if i in planes],"ddd",clip1.num_frames) if file is not None else None
         def tocsv(n,f,clip,core):
-            line=str(n)
-            line+=(","+str(f[0].props.PlaneSSIM)) if 0 in planes else ""
-            line+=(","+str(f[1].props.PlaneSSIM)) if 1 in planes else ""
-            line+=(","+str(f[2].props.PlaneSSIM)) if 2 in planes else ""
-            txt.write(line+"\n")
+            txt.put(n,[f[i].props.PlaneSSIM for i in range(3) if i in planes])
             return clip
-            txt.close()
-        last=core.std.FrameEval(clip1,functools.partial(tocsv, clip=clip1,core=core),prop_src=[R,G,B])
+        last=core.std.FrameEval(clip1,functools.partial(tocsv, clip=clip1,core=core),prop_src=[R,G,B]) if file is not None else _copyprops(clip1,[R,G,B],"PlaneSSIM",planes,"RGB")
     else:
         raise TypeError("unsupport format")
     return last
@@ -1684,7 +1903,9 @@ def GMSD2csv(clip1,clip2,file="GMSD.csv",planes=None, downsample=True,c=0.0026,*
 
         clip2: Reference clip, must be of the same format and dimension as the "clip1".
 
-        file:  output file name
+        file:  output file name,a name ending with .xfs writes a FrameStore instead of csv
+               None means write nothing and attach the scores to the output as props(PlaneGMSD for GRAY,PlaneGMSDY,PlaneGMSDU... otherwise),
+               to be collected with getprops
 
         plane: (int/list) Specify which planes to be processed. Default is None.
 
@@ -1705,59 +1926,203 @@ def GMSD2csv(clip1,clip2,file="GMSD.csv",planes=None, downsample=True,c=0.0026,*
         planes=[planes]
     if isGRAY:
         clip=muf.GMSD(clip1, clip2, plane=0, downsample=downsample, c=c,show_map=False, **depth_args)
-        txt = open(file,'w')
-        txt.write("n,gary\n")
+        txt = _framesink(file,["n","gary"],"d",clip.num_frames) if file is not None else None
         def tocsv(n, f, clip ,core):
-            txt.write(str(n)+","+str(f.props.PlaneGMSD)+"\n")
+            txt.put(n,[f.props.PlaneGMSD])
             return clip
-            txt.close()
-        last=core.std.FrameEval(clip,functools.partial(tocsv, clip=clip,core=core),prop_src=clip)
+        last=core.std.FrameEval(clip,functools.partial(tocsv, clip=clip,core=core),prop_src=clip) if file is not None else clip
     elif isYUV:
         if planes is None:
             planes=[0,1,2]
         Y=muf.GMSD(getY(clip1),getY(clip2),plane=0, downsample=downsample, c=c, show_map=False, **depth_args) if 0 in planes else getY(clip1)
         U=muf.GMSD(getU(clip1),getU(clip2),plane=0, downsample=downsample, c=c, show_map=False, **depth_args) if 1 in planes else getU(clip1)
         V=muf.GMSD(getV(clip1),getV(clip2),plane=0, downsample=downsample, c=c, show_map=False, **depth_args) if 2 in planes else getV(clip1)
-        txt = open(file,'w')
-        head="n"
-        head+=",Y" if 0 in planes else ""
-        head+=",U" if 1 in planes else ""
-        head+=",V" if 2 in planes else ""
-        txt.write(head+"\n")
+        txt = _framesink(file,["n"]+[p for i,p in enumerate("YUV") if i in planes],"ddd",clip1.num_frames) if file is not None else None
         def tocsv(n,f,clip,core):
-            line=str(n)
-            line+=(","+str(f[0].props.PlaneGMSD)) if 0 in planes else ""
-            line+=(","+str(f[1].props.PlaneGMSD)) if 1 in planes else ""
-            line+=(","+str(f[2].props.PlaneGMSD)) if 2 in planes else ""
-            txt.write(line+"\n")
+            txt.put(n,[f[i].props.PlaneGMSD for i in range(3) if i in planes])
             return clip
-            txt.close()
-        last=core.std.FrameEval(clip1,functools.partial(tocsv, clip=clip1,core=core),prop_src=[Y,U,V])
+        last=core.std.FrameEval(clip1,functools.partial(tocsv, clip=clip1,core=core),prop_src=[Y,U,V]) if file is not None else _copyprops(clip1,[Y,U,V],"PlaneGMSD",planes,"YUV")
     elif isRGB:
         if planes is None:
             planes=[0,1,2]
         R=muf.GMSD(getY(clip1),getY(clip2),plane=0, downsample=downsample, c=c, show_map=False, **depth_args) if 0 in planes else getY(clip1)
         G=muf.GMSD(getU(clip1),getU(clip2),plane=0, downsample=downsample, c=c, show_map=False, **depth_args) if 1 in planes else getU(clip1)
         B=muf.GMSD(getV(clip1),getV(clip2),plane=0, downsample=downsample, c=c, show_map=False, **depth_args) if 2 in planes else getV(clip1)
-        txt = open(file,'w')
-        head="n"
-        head+=",R" if 0 in planes else ""
-        head+=",G" if 1 in planes else ""
-        head+=",B" if 2 in planes else ""
-        txt.write(head+"\n")
+        txt = _framesink(file,["n"]+[p for i,p in enumerate("RGB") if i in planes],"ddd",clip1.num_frames) if file is not None else None
         def tocsv(n,f,clip,core):
-            line=str(n)
-            line+=(","+str(f[0].props.PlaneGMSD)) if 0 in planes else ""
-            line+=(","+str(f[1].props.PlaneGMSD)) if 1 in planes else ""
-            line+=(","+str(f[2].props.PlaneGMSD)) if 2 in planes else ""
-            txt.write(line+"\n")
+            txt.put(n,[f[i].props.PlaneGMSD for i in range(3) if i in planes])
             return clip
-            txt.close()
-        last=core.std.FrameEval(clip1,functools.partial(tocsv, clip=clip1,core=core),prop_src=[R,G,B])
+        last=core.std.FrameEval(clip1,functools.partial(tocsv, clip=clip1,core=core),prop_src=[R,G,B]) if file is not None else _copyprops(clip1,[R,G,B],"PlaneGMSD",planes,"RGB")
     else:
         raise TypeError("unsupport format")
     return last
 
+def metrics2csv(clip1,clip2,file="metrics.csv",metrics=("ssim","gmsd","psnr"),planes=None,downsample=True,k1=0.01,k2=0.03,fun=None,dynamic_range=1,c=0.0026,**depth_args):
+    """
+    Calculate SSIM,GMSD and PSNR in one graph and write one row per frame
+    each plane is extracted,converted to float and downsampled once,and shared by all metrics
+    Args:
+        clip1: The distorted clip, will be copied to output.
+
+        clip2: Reference clip, must be of the same format and dimension as the "clip1".
+
+        file:  output file name,a name ending with .xfs writes a FrameStore instead of csv
+               None means write nothing and attach the scores to the output as props(SSIM_Y,GMSD_Y,PSNR_Y...)
+               Columns are named the same way.
+
+        metrics: (list) Any of "ssim","gmsd","psnr". Default is all of them.
+
+        planes: (int/list) Specify which planes to be processed. Default is None.
+
+        downsample: (bool) Whether to average the clips over local 2x2 window and downsample by a factor of 2 before SSIM and GMSD.
+            PSNR is always calculated at full resolution.
+            Default is True.
+
+        k1, k2, fun, dynamic_range: same as ssim2csv.
+
+        c: same as GMSD2csv.
+
+        depth_args: (dict) Additional arguments passed to mvf.Depth() in the form of keyword arguments.
+            Default is {}.
+    """
+    family=clip1.format.color_family
+    if family==vs.GRAY:
+        pname="GRAY",
+    elif family==vs.YUV:
+        pname="YUV"
+    elif family==vs.RGB:
+        pname="RGB"
+    else:
+        raise TypeError("unsupport format")
+    if planes is None:
+        planes=list(range(len(pname)))
+    elif isinstance(planes,int):
+        planes=[planes]
+    metrics=[m.lower() for m in metrics]
+    for m in metrics:
+        if m not in ("ssim","gmsd","psnr"):
+            raise ValueError("unknown metric "+m)
+    #(column,clip,prop)
+    cols=[]
+    for i in planes:
+        a=mvf.Depth(getplane(clip1,i),depth=32,sample=vs.FLOAT,**depth_args)
+        b=mvf.Depth(getplane(clip2,i),depth=32,sample=vs.FLOAT,**depth_args)
+        if downsample and ("ssim" in metrics or "gmsd" in metrics):
+            ad,bd=_iqadown(a),_iqadown(b)
+        else:
+            ad,bd=a,b
+        for m in metrics:
+            name=m.upper()+"_"+pname[i]
+            if m=="ssim":
+                cols.append((name,muf.SSIM(ad,bd,plane=0,downsample=False,k1=k1,k2=k2,fun=fun,dynamic_range=dynamic_range,show_map=False),"PlaneSSIM"))
+            elif m=="gmsd":
+                cols.append((name,muf.GMSD(ad,bd,plane=0,downsample=False,c=c,show_map=False),"PlaneGMSD"))
+            else:
+                cols.append((name,core.std.PlaneStats(core.std.Expr([a,b],"x y - dup *")),"PlaneStatsAverage"))
+    def value(name,f,key):
+        v=f.props[key]
+        if name.startswith("PSNR"):
+            return 10*math.log10(1/v) if v > 0 else math.inf
+        return v
+    if file is None:
+        def copy(n,f):
+            fout=f[0].copy()
+            for (name,_,key),fi in zip(cols,f[1:]):
+                fout.props[name]=value(name,fi,key)
+            return fout
+        return core.std.ModifyFrame(clip1,[clip1]+[x[1] for x in cols],copy)
+    txt=_framesink(file,["n"]+[x[0] for x in cols],"d"*len(cols),clip1.num_frames)
+    def tocsv(n,f,clip):
+        txt.put(n,[value(name,fi,key) for (name,_,key),fi in zip(cols,f)])
+        return clip
+    return core.std.FrameEval(clip1,functools.partial(tocsv,clip=clip1),prop_src=[x[1] for x in cols])
+
+def samplemetrics(clip1,clip2,metrics=("ssim","gmsd"),step=None,samples=None,scenes=None,seed=0,confidence=0.95,progress=True,**metrics_args):
+    """
+    Estimate metrics of long clips from a sample of frames
+    only the sampled frames are decoded and measured,the result is the mean score with a confidence interval
+    Args:
+        clip1, clip2: same as metrics2csv.
+
+        metrics: (list) Any of "ssim","gmsd","psnr". Default is ("ssim","gmsd").
+
+        step: (int) Measure every step-th frame,at least one frame is measured.
+
+        samples: (int) Measure this many frames drawn at random,stratified by scenes.
+            Default is 1/10 of the frames when neither step nor samples is set.
+
+        scenes: (list) First frame of every scene(e.g. a keyframe index),samples are spread over scenes
+            in proportion to their length,at least one per scene.
+            If None, the clip is split into equal strata.
+
+        seed: random seed of the stratified sample. Default is 0.
+
+        confidence: (float) Confidence level of the interval. Default is 0.95.
+
+        progress: same as getprops.
+
+        metrics_args: other arguments of metrics2csv.
+
+    Returns a dict of column(SSIM_Y...) -> {"mean","low","high","frames"}
+    """
+    n=clip1.num_frames
+    if n < 1:
+        raise ValueError("samplemetrics: clip has no frames")
+    if step is not None and step < 1:
+        raise ValueError("samplemetrics: step must be at least 1")
+    if samples is not None and samples < 1:
+        raise ValueError("samplemetrics: samples must be at least 1")
+    if step is not None:
+        #the middle of the first step,or the last frame when step is longer than the clip
+        frames=list(range(min(step//2,n-1),n,step))
+        strata=[(0,n,frames)]
+    else:
+        samples=min(samples if samples else max(n//10,1),n)
+        bounds=sorted(set([0]+[x for x in (scenes or []) if 0 < x < n]+[n]))
+        if scenes is None:
+            k=max(samples//2,1)
+            bounds=sorted(set(n*i//k for i in range(k+1)))
+        rnd=random.Random(seed)
+        strata=[]
+        for a,b in zip(bounds[:-1],bounds[1:]):
+            k=max(min(round(samples*(b-a)/n),b-a),1)
+            strata.append((a,b,sorted(rnd.sample(range(a,b),k))))
+        frames=[x for _,_,fs in strata for x in fs]
+    sel1=core.std.SelectEvery(clip1,n,frames)
+    sel2=core.std.SelectEvery(clip2,n,frames)
+    last=metrics2csv(sel1,sel2,file=None,metrics=metrics,**metrics_args)
+    family=clip1.format.color_family
+    pname=("GRAY",) if family==vs.GRAY else "YUV" if family==vs.YUV else "RGB"
+    names=[m.upper()+"_"+p for m in metrics for p in pname]
+    props=getprops(last,names,progress=progress)
+    names=[x for x in names if not all(map(math.isnan,props[x]))]
+    z=statistics.NormalDist().inv_cdf((1+confidence)/2)
+    result={}
+    for name in names:
+        values=list(props[name])
+        pooled=statistics.variance(values) if len(values) > 1 else 0
+        mean=0
+        var=0
+        i=0
+        #stratified estimate,strata with a single sample use the pooled variance
+        for a,b,fs in strata:
+            v=values[i:i+len(fs)]
+            i+=len(fs)
+            w=(b-a)/n
+            mean+=w*statistics.fmean(v)
+            s2=statistics.variance(v) if len(v) > 1 else pooled
+            var+=w*w*s2/len(v)*(1-len(v)/(b-a))
+        half=z*math.sqrt(var)
+        result[name]={"mean":mean,"low":mean-half,"high":mean+half,"frames":len(values)}
+    return result
+
+def _iqadown(clip):
+    """
+    2x2 average then downsample by 2,as done by muvsfunc's IQA functions
+    """
+    clip=core.std.Convolution(clip,[1,1,0,1,1,0,0,0,0])
+    return core.resize.Point(clip,clip.width//2,clip.height//2,src_left=-1,src_top=-1)
+
 def ssharp(clip,chroma=True,mask=False,compare=False):
     """
     slightly sharp through bicubic
@@ -2152,6 +2517,523 @@ def drAA(src,drf=0.5,lraa=True,opencl=False,device=-1,pp=True):
         last= Ylast
     return last
 
+class _OrderedWriter:
+    """
+    write per frame lines from FrameEval callbacks in frame order
+    --------------------------------
+    lines wait until every earlier frame arrived,then go to a background thread in batches
+    repeated frames are written once,the file is closed after the last frame or at exit
+    """
+    def __init__(self,file,header,total,batch=256):
+        self.f = open(file,"w")
+        self.f.write(header)
+        self.total = total
+        self.batch = batch
+        self.next = 0
+        self.pending = {}
+        self.buf = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run,daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            lines = self.queue.get()
+            if lines is None:
+                break
+            self.f.writelines(lines)
+        self.f.close()
+
+    def write(self,n,line):
+        with self.lock:
+            if self.closed or n < self.next or n in self.pending:
+                return
+            self.pending[n] = line
+            while self.next in self.pending:
+                self.buf.append(self.pending.pop(self.next))
+                self.next += 1
+            if len(self.buf) >= self.batch or self.next >= self.total:
+                self.queue.put(self.buf)
+                self.buf = []
+            if self.next >= self.total:
+                self.closed = True
+                self.queue.put(None)
+
+    def put(self,n,values):
+        self.write(n,",".join(str(v) for v in [n]+list(values))+"\n")
+
+    def close(self):
+        """
+        write what has arrived,including frames after a gap,and close the file
+        """
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.queue.put(self.buf+[self.pending[n] for n in sorted(self.pending)])
+                self.queue.put(None)
+        self.thread.join()
+
+class FrameStore:
+    """
+    FrameStore
+    --------------------------------
+    columnar binary file of per frame results,one fixed width typed column per value,indexed by frame number
+    the file is memory mapped,so reading a range of frames is a slice without any parsing
+    --------------------------------
+    create:FrameStore.create(path,names,types,frames)
+        types:one array typecode per column,e.g. "d" float64,"i" int32,"B" uint8
+        columns are written in native byte order,which is saved in the header
+    read:FrameStore(path)["Y"][a:b],FrameStore(path).array("Y",a,b) for a numpy view
+        a file from a machine of the other byte order is read into byteswapped copies,it can't be opened for writing
+    valid:FrameStore(path).valid[n] is 1 if frame n has been written
+    """
+    magic = b"XVSFS2"
+
+    def __init__(self,path,write=False):
+        self.path = path
+        self.file = open(path,"r+b" if write else "rb")
+        self.mm = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+        if self.mm[:6] != self.magic:
+            raise ValueError("FrameStore: {} is not a FrameStore file".format(path))
+        hlen, = struct.unpack_from("<I",self.mm,6)
+        head = json.loads(self.mm[10:10+hlen].decode())
+        self.frames = head["frames"]
+        self.names = [c[0] for c in head["columns"]]
+        self.types = "".join(c[1] for c in head["columns"])
+        swap = head["byteorder"] != sys.byteorder
+        if swap and write:
+            raise ValueError("FrameStore: {} is {} endian,can't write it on this machine".format(path,head["byteorder"]))
+        self.view = memoryview(self.mm)
+        self.columns = {}
+        off = head["offset"]
+        for name,t in head["columns"]+[["_valid","B"]]:
+            size = array.array(t).itemsize*self.frames
+            if swap:
+                self.columns[name] = array.array(t,self.view[off:off+size].tobytes())
+                self.columns[name].byteswap()
+            else:
+                self.columns[name] = self.view[off:off+size].cast(t)
+            off += -(-size//8)*8
+        self.valid = self.columns["_valid"]
+        if write:
+            atexit.register(self.close)
+
+    @classmethod
+    def create(cls,path,names,types,frames):
+        cols = [[n,t] for n,t in zip(names,types)]
+        head = {"frames":frames,"columns":cols,"byteorder":sys.byteorder,"offset":0}
+        hlen = len(json.dumps(head).encode())+32
+        head["offset"] = -(-(10+hlen)//64)*64
+        data = json.dumps(head).encode().ljust(hlen)
+        size = head["offset"]+sum(-(-array.array(t).itemsize*frames//8)*8 for n,t in cols+[["_valid","B"]])
+        with open(path,"wb") as f:
+            f.write(cls.magic+struct.pack("<I",hlen)+data)
+            f.truncate(size)
+        return cls(path,write=True)
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self,name):
+        return self.columns[name]
+
+    def put(self,n,values):
+        for name,v in zip(self.names,values):
+            self.columns[name][n] = v
+        self.valid[n] = 1
+
+    def array(self,name,start=0,end=None):
+        import numpy as np
+        col = self.columns[name]
+        return np.frombuffer(col,dtype=col.typecode if isinstance(col,array.array) else col.format)[start:end]
+
+    def tocsv(self,path,start=0,end=None):
+        """
+        export written frames in [start,end) to csv
+        """
+        end = self.frames if end is None else end
+        cols = [self.columns[name] for name in self.names]
+        with open(path,"w") as f:
+            f.write(",".join(["n"]+self.names)+"\n")
+            f.writelines(",".join(str(v) for v in [n]+[c[n] for c in cols])+"\n" for n in range(start,end) if self.valid[n])
+
+    def close(self):
+        if self.mm.closed:
+            return
+        for v in self.columns.values():
+            if isinstance(v,memoryview):
+                v.release()
+        self.view.release()
+        self.mm.close()
+        self.file.close()
+
+def _framesink(file,names,types,total):
+    """
+    per frame result sink,FrameStore if file ends with .xfs,otherwise csv written in frame order
+    names:column names,the first one is the frame number column of the csv
+    """
+    if file.lower().endswith(".xfs"):
+        return FrameStore.create(file,names[1:],types,total)
+    return _OrderedWriter(file,",".join(names)+"\n",total)
+
+#timecodes
+class Timecodes:
+    """
+    Timecodes
+    --------------------------------
+    frame timestamps in milliseconds,stored as integer multiples of 1/base ms in an array('q')
+    each entry is rounded once from an exact rational value,so long files don't drift
+    base: timestamps resolution,default is 1000000(1ns)
+    key: three ints saved with the index,identify what the timestamps were built from,default is (0,0,0)
+    """
+    def __init__(self,base=1000000):
+        self.base = base
+        self.data = array.array('q')
+        self.key = (0,0,0)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self,n):
+        if isinstance(n,slice):
+            return [Fraction(i,self.base) for i in self.data[n]]
+        return Fraction(self.data[n],self.base)
+
+    def __iter__(self):
+        return (Fraction(i,self.base) for i in self.data)
+
+    def append(self,t):
+        self.data.append(round(Fraction(t)*self.base))
+
+    def extend(self,ts):
+        for t in ts:
+            self.append(t)
+
+    def index(self,t):
+        """
+        index of the last timestamp <= t,-1 if t is before the first one
+        """
+        return bisect.bisect_right(self.data,math.floor(Fraction(t)*self.base))-1
+
+    def save(self,path):
+        with open(path,"wb") as f:
+            f.write(b"XVSTC2"+struct.pack("<qqqqq",self.base,len(self.data),*self.key))
+            self.data.tofile(f)
+
+    @classmethod
+    def load(cls,path):
+        with open(path,"rb") as f:
+            if f.read(6) != b"XVSTC2":
+                raise ValueError("Timecodes: {} is not a timestamps index".format(path))
+            base,count,*key = struct.unpack("<qqqqq",f.read(40))
+            tc = cls(base)
+            tc.key = tuple(key)
+            tc.data.fromfile(f,count)
+        return tc
+
+def itertc(path,num_frames=None):
+    """
+    itertc
+    --------------------------------
+    stream the timestamps(ms,as Fraction) of a timecodes v1/v2 file line by line
+    path: timecodes file
+    num_frames: number of frames,needed to expand the assumed fps of a v1 file beyond its last range
+    a v1 file also yields the end time of the last frame
+    """
+    with open(path,"r") as f:
+        header = f.readline().lower()
+        if "v2" in header:
+            for line in f:
+                line = line.strip()
+                if line and line[0] != "#":
+                    yield Fraction(line)
+        elif "v1" in header:
+            assume = None
+            ranges = []
+            for line in f:
+                line = line.strip()
+                if not line or line[0] == "#":
+                    continue
+                if line.lower().startswith("assume"):
+                    assume = Fraction(line.split()[1])
+                else:
+                    a,b,fps = line.split(",")
+                    ranges.append((int(a),int(b),Fraction(fps)))
+            if assume is None:
+                raise ValueError("itertc: v1 timecodes without assume line")
+            ranges.sort()
+            if num_frames is None:
+                num_frames = ranges[-1][1]+1 if ranges else 0
+            t = Fraction(0)
+            r = 0
+            for n in range(num_frames):
+                yield t
+                while r < len(ranges) and ranges[r][1] < n:
+                    r += 1
+                t += 1000/(ranges[r][2] if r < len(ranges) and ranges[r][0] <= n else assume)
+            yield t
+        else:
+            raise ValueError("itertc: unknown timecodes format")
+
+def readtc(path,num_frames=None,base=1000000):
+    """
+    read a timecodes v1/v2 file into Timecodes in one pass
+    """
+    tc = Timecodes(base)
+    tc.extend(itertc(path,num_frames))
+    return tc
+
+def proptc(clip,cache=None,base=1000000,source=None):
+    """
+    proptc
+    --------------------------------
+    build Timecodes from the _DurationNum/_DurationDen props of every frame,including the end time of the last frame
+    clip: source clip,frames are only requested for their props
+    cache: compact index file,loaded instead of reading props again if it was built from the same source
+    source: path of the source file,its size and mtime identify the cache,
+            if None the durations of the first and last frame and the clip length are used
+    """
+    n = clip.num_frames
+    if cache is not None:
+        if source is not None:
+            st = os.stat(source)
+            key = (st.st_size, st.st_mtime_ns, n)
+        else:
+            dur = lambda f: round(Fraction(1000*f.props["_DurationNum"],f.props["_DurationDen"])*base)
+            key = (dur(clip.get_frame(0)), dur(clip.get_frame(n-1)), n)
+        try:
+            tc = Timecodes.load(cache)
+        except (OSError,ValueError):
+            tc = None
+        if tc is not None and tc.key == key and tc.base == base and len(tc) == n+1:
+            return tc
+    tc = Timecodes(base)
+    t = Fraction(0)
+    tc.append(t)
+    for n,f in _prefetch(clip):
+        t += Fraction(1000*f.props["_DurationNum"],f.props["_DurationDen"])
+        tc.append(t)
+    if cache is not None:
+        tc.key = key
+        tc.save(cache)
+    return tc
+
+def getprops(clip,props,start=0,end=None,window=None,progress=True):
+    """
+    getprops
+    --------------------------------
+    render frames in process and collect their props into numpy arrays,no vspipe needed
+    clip: clip carrying the props,e.g. ssim2csv(clip1,clip2,file=None)
+    props: names of the props to collect
+    start,end: frames in [start,end),default is the whole clip
+    window: frames requested at the same time,default:2*core.num_threads
+    progress: True prints done frames and fps to stderr,a function is called as progress(done,total,fps)
+    return: dict of prop name -> float64 array,nan where a frame has no such prop
+    """
+    import numpy as np
+    end = clip.num_frames if end is None else end
+    total = end-start
+    out = {p:np.full(total,np.nan) for p in props}
+    for n,f in _progress(_prefetch(clip,start,end,window),total,progress):
+        for p in props:
+            if p in f.props:
+                out[p][n-start] = f.props[p]
+    return out
+
+def scenesummary(clip,props,file="scenes.csv",threshold=0.1,quantiles=(0.05,),start=0,end=None,window=None,progress=True):
+    """
+    scenesummary
+    --------------------------------
+    render frames in process and write one row of aggregates per scene instead of one row per frame
+    mean/min/max are exact,quantiles come from a five marker streaming estimate,memory doesn't grow with the clip
+    clip: clip carrying the props,e.g. ssim2csv(clip1,clip2,file=None),metrics2csv(...,file=None) or core.std.PlaneStats(clip)
+    props: names of the props to summarize
+    file: output csv,columns are scene,first,last,frames and prop.mean,prop.min,prop.max,prop.p5... for every prop
+    threshold: threshold of misc.SCDetect run in the same pass,None means the clip already has _SceneChangePrev
+    quantiles: quantiles to estimate,default:(0.05,)
+    start,end,window,progress: same as getprops
+    return: number of scenes
+    """
+    if not props:
+        raise ValueError("scenesummary: props must name at least one prop")
+    end = clip.num_frames if end is None else end
+    if threshold is not None:
+        clip = core.misc.SCDetect(clip,threshold=threshold)
+    qnames = ["p{:g}".format(q*100) for q in quantiles]
+    head = ["scene","first","last","frames"]+[p+"."+k for p in props for k in ["mean","min","max"]+qnames]
+    scenes = 0
+    acc = None
+    first = start
+    def row():
+        line = [scenes,first,last,last-first+1]
+        for m,qs in acc:
+            line += [m.mean,m.min,m.max]+[q.value() for q in qs]
+        return ",".join(str(v) for v in line)+"\n"
+    with open(file,"w") as f:
+        f.write(",".join(head)+"\n")
+        for n,fr in _progress(_prefetch(clip,start,end,window),end-start,progress):
+            if acc is None or fr.props.get("_SceneChangePrev",0):
+                if acc is not None:
+                    f.write(row())
+                    scenes += 1
+                acc = [(_Moments(),[_P2Quantile(q) for q in quantiles]) for p in props]
+                first = n
+            for p,(m,qs) in zip(props,acc):
+                if p in fr.props:
+                    v = fr.props[p]
+                    m.add(v)
+                    for q in qs:
+                        q.add(v)
+            last = n
+        if acc is not None:
+            f.write(row())
+            scenes += 1
+    return scenes
+
+class _Moments:
+    """
+    running count/mean/variance(Welford)/min/max
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self,x):
+        self.count += 1
+        d = x-self.mean
+        self.mean += d/self.count
+        self.m2 += d*(x-self.mean)
+        self.min = min(self.min,x)
+        self.max = max(self.max,x)
+
+    def variance(self):
+        return self.m2/(self.count-1) if self.count > 1 else 0.0
+
+class _P2Quantile:
+    """
+    streaming quantile estimate with five markers(P-square algorithm,Jain & Chlamtac 1985)
+    """
+    def __init__(self,p):
+        self.p = p
+        self.q = []
+        self.n = [0,1,2,3,4]
+        self.np = [0,2*p,4*p,2+2*p,4]
+        self.dn = [0,p/2,p,(1+p)/2,1]
+
+    def add(self,x):
+        q,n = self.q,self.n
+        if len(q) < 5:
+            bisect.insort(q,x)
+            return
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(q,x)-1
+        for i in range(k+1,5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+        for i in (1,2,3):
+            d = self.np[i]-n[i]
+            if (d >= 1 and n[i+1]-n[i] > 1) or (d <= -1 and n[i-1]-n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = q[i]+d/(n[i+1]-n[i-1])*((n[i]-n[i-1]+d)*(q[i+1]-q[i])/(n[i+1]-n[i])+(n[i+1]-n[i]-d)*(q[i]-q[i-1])/(n[i]-n[i-1]))
+                if not q[i-1] < qp < q[i+1]:
+                    qp = q[i]+d*(q[i+d]-q[i])/(n[i+d]-n[i])
+                q[i] = qp
+                n[i] += d
+
+    def value(self):
+        if not self.q:
+            return math.nan
+        if len(self.q) < 5:
+            return self.q[round(self.p*(len(self.q)-1))]
+        return self.q[2]
+
+def _copyprops(clip,srcs,key,planes,pnames):
+    """
+    copy prop key of srcs[i] to clip as key+pnames[i] for i in planes
+    """
+    def copy(n,f):
+        fout=f[0].copy()
+        for i in planes:
+            fout.props[key+pnames[i]]=f[i+1].props[key]
+        return fout
+    return core.std.ModifyFrame(clip,[clip]+srcs,copy)
+
+def _prefetch(clip,start=0,end=None,window=None):
+    """
+    yield (n,frame) in order,keeping at most window requests in flight
+    """
+    end = clip.num_frames if end is None else end
+    window = window if window else 2*core.num_threads
+    pending = deque()
+    n = start
+    while n < end or pending:
+        while n < end and len(pending) < window:
+            pending.append((n,clip.get_frame_async(n)))
+            n += 1
+        i,fut = pending.popleft()
+        yield i,fut.result()
+
+def _progress(frames,total,progress=True):
+    """
+    pass (n,frame) through,reporting done frames and fps every 100 frames and at the end
+    progress: True prints to stderr,a function is called as progress(done,total,fps),False is silent
+    """
+    t0 = time.perf_counter()
+    done = 0
+    for n,f in frames:
+        yield n,f
+        done += 1
+        if progress and (done%100 == 0 or done == total):
+            fps = done/max(time.perf_counter()-t0,1e-9)
+            if callable(progress):
+                progress(done,total,fps)
+            else:
+                sys.stderr.write("\r{}/{} frames,{:.2f} fps".format(done,total,fps))
+    if progress is True and total > 0:
+        sys.stderr.write("\n")
+
+def _tcfmt(t,digits=6):
+    q = round(Fraction(t)*10**digits)
+    sign = "-" if q < 0 else ""
+    q = abs(q)
+    return (sign+"{}.{:0{}d}".format(q//10**digits,q%10**digits,digits)).rstrip("0").rstrip(".")
+
+def writetcv1(path,assume,ranges):
+    """
+    writetcv1
+    --------------------------------
+    path: output file
+    assume: default fps(int/float/Fraction)
+    ranges: iterable of (first frame,last frame,fps)
+    """
+    with open(path,"w") as f:
+        f.write("# timecode format v1\nAssume "+_tcfmt(assume,10)+"\n")
+        f.writelines("{},{},{}\n".format(a,b,_tcfmt(fps,10)) for a,b,fps in ranges)
+
+def writetcv2(path,timestamps):
+    """
+    writetcv2
+    --------------------------------
+    path: output file
+    timestamps: iterable of timestamps in ms(int/Fraction),consumed lazily
+    """
+    with open(path,"w") as f:
+        f.write("# timecode format v2\n")
+        f.writelines(_tcfmt(t)+"\n" for t in timestamps)
+
 #helper function:
 
 